@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+#
+# Throughput of the file name parser over a synthetic corpus of movie and episode names in the usual forms
+# (S01E02, S01E01E02, 1x02, daily shows by air date, release junk, years in titles).
+#
+# python3 benchmarks/filenames.py [--names 100000] [--json]
+#
+import sys, os
+import argparse
+import collections
+import json
+import random
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tagmkv import FilenameParser
+
+words = ['The', 'Last', 'Night', 'Star', 'House', 'of', 'Dragon', 'City', 'Blue', 'Lost', 'Man', 'Dark', 'River',
+         'Station', 'Eleven', 'Good', 'Place', 'Office', 'Crown', 'Wire', 'Alien', '2049', 'Matrix', 'Show']
+junk = ['', '.720p', '.1080p.BluRay.x264', '.2160p.WEB-DL', '.HDTV', '.480p.DVDRip', '']
+
+def title(rng, separator):
+    return separator.join(rng.choice(words) for _ in range(rng.randint(1, 4)))
+
+def synthetic_name(rng):
+    separator = rng.choice(['.', ' ', '_'])
+    show = title(rng, separator)
+    season, episode = rng.randint(1, 30), rng.randint(1, 24)
+    form = rng.randrange(6)
+    if form == 0:
+        name = f"{show}{separator}S{season:02}E{episode:02}{separator}{title(rng, separator)}{rng.choice(junk)}"
+    elif form == 1:
+        name = f"{show}{separator}S{season:02}E{episode:02}E{episode + 1:02}{rng.choice(junk)}"
+    elif form == 2:
+        name = f"{show} - {season}x{episode:02} - {title(rng, ' ')}"
+    elif form == 3:
+        name = f"{show}{separator}{rng.randint(1990, 2023)}.{rng.randint(1, 12):02}.{rng.randint(1, 28):02}{rng.choice(junk)}"
+    elif form == 4:
+        name = f"{show}{separator}{rng.randint(1950, 2023)}{rng.choice(junk)}"
+    else:
+        name = f"{show} ({rng.randint(1950, 2023)})"
+    return name + rng.choice(['.mkv', '.mka'])
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Time the file name parser.')
+    parser.add_argument('--names', type=int, default=100000)
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    args = parser.parse_args(argv)
+
+    rng = random.Random(1)
+    names = [synthetic_name(rng) for _ in range(args.names)]
+    filename_parser = FilenameParser()
+    started = time.perf_counter()
+    parsed = filename_parser.parse_all(names)
+    elapsed = time.perf_counter() - started
+    kinds = collections.Counter('daily' if result.get('air_date') else 'episode' if 'show' in result else 'movie'
+                                for result in parsed)
+    result = {
+        'names': len(names),
+        'seconds': elapsed,
+        'names_per_second': len(names) / elapsed if elapsed else None,
+        'parsed': dict(kinds),
+    }
+    if args.json:
+        print (json.dumps(result, indent=2))
+    else:
+        print (f"{result['names']} names in {elapsed:.2f}s, {result['names_per_second']:.0f} names/s "
+               f"({', '.join(f'{count} {kind}' for kind, count in sorted(kinds.items()))})")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
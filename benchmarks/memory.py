@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+#
+# How much memory a big library takes once every file's tags have been read. Builds synthetic MediaFiles (names
+# like a TV library, a cast drawn from a pool so episodes of a show share people, the way they do for real) and
+# reports the bytes allocated per file.
+#
+# python3 benchmarks/memory.py [--files 5000] [--cast 40] [--json]
+#
+# With the defaults a file takes about 13.8KB. That was about 9.2KB before MediaFile kept its property index (the
+# dict of properties by key), which is most of the difference.
+#
+import sys, os
+import argparse
+import gc
+import json
+import random
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tagmkv import MediaFile
+
+# Episodes per show, and the people who appear across one show.
+episodes_per_show = 50
+people_per_show = 120
+
+def synthetic_tags(show, episode, cast_size, crew_size, rng):
+    people = [f"Person {show}-{person}" for person in range(people_per_show)]
+    xml_tags = {
+        'TITLE': f"Episode {episode}",
+        'SHOW': f"Show {show}",
+        'SEASON': str(episode // 10 + 1),
+        'EPISODE': str(episode % 10 + 1),
+        'SUMMARY': f"Show {show} episode {episode}. " + 'Something happens. ' * 20,
+        'DATE_RELEASED': '2020-01-01',
+        'GENRE': 'Drama|Comedy',
+        'TMDB': f"tv/{show}",
+        'MEDIA_TYPE': '10',
+        'cast': [{'ACTOR': actor, 'CHARACTER': f"Character of {actor}"}
+                 for actor in rng.sample(people, min(cast_size, len(people)))],
+        'crew': [{'job': MediaFile.crew_tags[job % len(MediaFile.crew_tags)], 'person': rng.choice(people)}
+                 for job in range(crew_size)],
+    }
+    return xml_tags
+
+def build_library(files, cast_size, crew_size):
+    rng = random.Random(1)
+    library = []
+    for number in range(files):
+        show, episode = divmod(number, episodes_per_show)
+        name = f"/library/Show.{show}/Show.{show}.S{episode // 10 + 1:02}E{episode % 10 + 1:02}.Episode.{episode}.mkv"
+        mediafile = MediaFile(name, lazy=True)
+        mediafile.apply_tags(synthetic_tags(show, episode, cast_size, crew_size, rng))
+        mediafile.analyzed = True
+        library.append(mediafile)
+    return library
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Report the memory used per MediaFile.')
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--cast', type=int, default=40)
+    parser.add_argument('--crew', type=int, default=8)
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    args = parser.parse_args(argv)
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    library = build_library(args.files, args.cast, args.crew)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    result = {
+        'files': len(library),
+        'cast': args.cast,
+        'crew': args.crew,
+        'properties_per_file': sum(len(mediafile.properties) for mediafile in library) / max(1, len(library)),
+        'bytes': allocated,
+        'bytes_per_file': allocated / max(1, len(library)),
+    }
+    if args.json:
+        print (json.dumps(result, indent=2))
+    else:
+        print (f"{result['files']} files, {result['properties_per_file']:.0f} properties each: "
+               f"{result['bytes'] / 1024 / 1024:.1f}MB, {result['bytes_per_file']:.0f} bytes per file")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
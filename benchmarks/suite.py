@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+#
+# End to end timings: generates synthetic Matroska files (0 to 500 cast entries, TV and movie names) and times each
+# stage of the pipeline, then a cold start of the UI up to the first window. Runs offline and without a display
+# (offscreen Qt, TMDb cache only), results are JSON so runs can be compared between releases.
+#
+# python3 benchmarks/suite.py [--files 20] [--cast 0,10,50,100,500] [--output results.json]
+#
+import sys, os
+import argparse
+import json
+import platform
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+
+#
+# Per stage timings, each stage is a list of seconds.
+#
+class Timings():
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        self.stages.setdefault(stage, []).append(seconds)
+
+    # Time fn, the sample goes in each of the stages (e.g. overall and per cast size).
+    def time(self, stages, fn, *args):
+        started = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - started
+        for stage in ([stages] if isinstance(stages, str) else stages):
+            self.add(stage, elapsed)
+        return result
+
+    def summary(self):
+        summary = {}
+        for stage, samples in self.stages.items():
+            samples = sorted(samples)
+            summary[stage] = {'count': len(samples), 'total': sum(samples), 'mean': sum(samples) / len(samples),
+                              'median': samples[len(samples) // 2], 'min': samples[0], 'max': samples[-1]}
+        return summary
+
+#
+# Synthetic files, laid out the way mkvmerge writes them: SeekHead, Info, Tags followed by Void padding, then one
+# Cluster of dummy frame data.
+#
+def simple_tags(name, cast_size, rng):
+    tags = [('TITLE', name, []), ('SUMMARY', 'Something happens. ' * 20, []), ('DATE_RELEASED', '2020-01-01', []),
+            ('GENRE', 'Drama|Comedy', []), ('DIRECTOR', 'Some Director', []), ('WRITEN_BY', 'Some Writer', [])]
+    episode = re.search(r'^(.*)\.S(\d+)E(\d+)\.', name)
+    if episode:
+        tags += [('MEDIA_TYPE', '10', []), ('SHOW', episode.group(1).replace('.', ' '), []),
+                 ('SEASON', str(int(episode.group(2))), []), ('EPISODE', str(int(episode.group(3))), [])]
+    else:
+        tags.append(('MEDIA_TYPE', '9', []))
+    for actor in range(cast_size):
+        tags.append(('ACTOR', f"Actor {rng.randint(0, 100000)}", [('CHARACTER', f"Character {actor}", [])]))
+    return tags
+
+def matroska_file(path, title, tags, payload=64 * 1024):
+    from tagmkv import MatroskaFile as M
+    header = M.encode_element(M.EBML, M.encode_string(0x4282, 'matroska') + M.encode_uint(0x4287, 4) +
+                              M.encode_uint(0x4285, 2))
+    info = M.encode_element(M.INFO, M.encode_uint(0x2AD7B1, 1000000) + M.encode_string(M.TITLE, title))
+    tag = M.encode_element(M.TARGETS, M.encode_uint(M.TARGET_TYPE_VALUE, 50))
+    for simple_tag in tags:
+        tag += M.encode_simple_tag(*simple_tag)
+    tags_element = M.encode_element(M.TAGS, M.encode_element(M.TAG, tag), 4) + M.encode_void(4096)
+    cluster = M.encode_element(M.CLUSTER, M.encode_uint(0xE7, 0) + M.encode_element(0xA3, os.urandom(payload), 4), 4)
+
+    def seek(element_id, position):
+        return M.encode_element(M.SEEK, M.encode_element(M.SEEK_ID, M.encode_id(element_id)) +
+                                M.encode_element(M.SEEK_POSITION, position.to_bytes(8, 'big')))
+    # The SeekHead size doesn't depend on the positions, 8 byte positions throughout.
+    seek_head_size = len(M.encode_element(M.SEEK_HEAD, seek(M.INFO, 0) + seek(M.TAGS, 0)))
+    seek_head = M.encode_element(M.SEEK_HEAD, seek(M.INFO, seek_head_size) +
+                                 seek(M.TAGS, seek_head_size + len(info)))
+    segment = seek_head + info + tags_element + cluster
+    with open(path, 'wb') as f:
+        f.write(header + M.encode_element(M.SEGMENT, segment, 8))
+
+def file_name(number, rng):
+    if number % 2:
+        return f"Show.{number}.S{rng.randint(1, 9):02}E{rng.randint(1, 20):02}.Episode.Title.1080p.mkv"
+    return f"Movie.{number}.{rng.randint(1950, 2020)}.720p.BluRay.x264.mkv"
+
+def make_fixtures(directory, files, cast_sizes):
+    rng = random.Random(1)
+    fixtures = {}
+    number = 0
+    for cast_size in cast_sizes:
+        paths = []
+        for _ in range(files):
+            name = file_name(number, rng)
+            path = os.path.join(directory, f"cast{cast_size}", name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            matroska_file(path, os.path.splitext(name)[0], simple_tags(name, cast_size, rng))
+            paths.append(path)
+            number += 1
+        fixtures[cast_size] = paths
+    return fixtures
+
+#
+# The stages.
+#
+def bench_files(timings, fixtures):
+    import tagmkv
+    tagmkv.MediaFile.use_tag_cache = False
+    for cast_size, paths in fixtures.items():
+        def stage(name):
+            return (name, f"{name}[cast={cast_size}]")
+        for path in paths:
+            mediafile = timings.time(stage('parse_filename'), tagmkv.MediaFile, path, True)
+            timings.time(stage('analyze_file'), mediafile.ensure_analyzed)
+            timings.time(stage('generate_xml'), mediafile.GenerateXML)
+            # A real edit, an unchanged file isn't written at all.
+            mediafile.metadata['tags']['title'] = 'Edited title'
+            mediafile.uniqueProperty(tagmkv.Property('TITLE', 'Edited title'))
+            if not timings.time(stage('save_tags'), mediafile.save_tags):
+                print (f"Save failed for {path}")
+            mediafile = tagmkv.MediaFile(path)
+            if mediafile.metadata['tags'].get('title') != 'Edited title':
+                print (f"Save not read back from {path}")
+
+def bench_model(timings, fixtures):
+    import tagmkv
+    from PyQt5.QtWidgets import QApplication, QListView
+    app = QApplication.instance() or QApplication([])
+    paths = [path for paths in fixtures.values() for path in paths]
+    # Enough rows to see the batching, the files themselves are only listed.
+    names = [os.path.join('/library', os.path.basename(path)) for path in paths] * max(1, 10000 // len(paths))
+    mediafiles = [tagmkv.MediaFile(name, lazy=True) for name in names]
+    model = tagmkv.MediaFileModel()
+    view = QListView()
+    view.setModel(model)
+    view.show()
+    started = time.perf_counter()
+    for start in range(0, len(mediafiles), 100):
+        model.insert_files([(mediafile, order) for order, mediafile in
+                            enumerate(mediafiles[start:start + 100], start)])
+        app.processEvents()
+    elapsed = time.perf_counter() - started
+    timings.add('model_population', elapsed)
+    timings.add('model_population_per_file', elapsed / len(mediafiles))
+
+# Runs in a fresh interpreter, prints the seconds from its start to the first window being shown.
+cold_start_script = '''
+import time
+started = time.perf_counter()
+import sys
+sys.path.insert(0, {root_dir!r})
+import tagmkv
+tagmkv.TMDbSession.offline = True
+from PyQt5.QtWidgets import QApplication
+app = QApplication(sys.argv)
+win = tagmkv.MainWindow()
+win.show()
+app.processEvents()
+print('STARTUP', time.perf_counter() - started)
+'''
+
+def bench_cold_start(timings, runs, cache_dir):
+    env = dict(os.environ, QT_QPA_PLATFORM='offscreen', XDG_CACHE_HOME=cache_dir)
+    script = cold_start_script.format(root_dir=root_dir)
+    for run in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', script], env=env, capture_output=True, text=True, timeout=120)
+        elapsed = time.perf_counter() - started
+        lines = [line for line in result.stdout.splitlines() if line.startswith('STARTUP ')]
+        if result.returncode != 0 or not lines:
+            print (f"Cold start failed: {result.stderr[-2000:]}")
+            return
+        timings.add('cold_start_process', elapsed)
+        timings.add('cold_start_first_window', float(lines[-1].split()[1]))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Time each stage of tagmkv over synthetic Matroska files.')
+    parser.add_argument('--files', type=int, default=20, help='files per cast size')
+    parser.add_argument('--cast', type=str, default='0,10,50,100,500', help='cast sizes to generate')
+    parser.add_argument('--cold-starts', type=int, default=3, help='number of UI cold starts to time')
+    parser.add_argument('--output', type=str, help='write the JSON results here instead of stdout')
+    parser.add_argument('--keep', action='store_true', help="don't delete the generated files")
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix='tagmkv-bench-')
+    # Our own caches, so nothing from a real session is used (or touched).
+    os.environ['XDG_CACHE_HOME'] = os.path.join(work_dir, 'cache')
+    import tagmkv
+    tagmkv.TMDbSession.offline = True
+    timings = Timings()
+    try:
+        cast_sizes = [int(size) for size in args.cast.split(',')]
+        fixtures = timings.time('make_fixtures', make_fixtures, os.path.join(work_dir, 'files'), args.files,
+                                cast_sizes)
+        bench_files(timings, fixtures)
+        bench_model(timings, fixtures)
+        if args.cold_starts:
+            bench_cold_start(timings, args.cold_starts, os.environ['XDG_CACHE_HOME'])
+    finally:
+        if args.keep:
+            print (f"Files kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'files_per_cast_size': args.files,
+        'cast_sizes': cast_sizes,
+        'stages': timings.summary(),
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print (json.dumps(results, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
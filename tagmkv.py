@@ -5,28 +5,45 @@
 from __future__ import print_function, unicode_literals
 
 import sys, os
+import bisect
+import collections
+import contextlib
+import io
 import json
-import pickle
+import logging
 import re
+import time
 import datetime
+import difflib
+import hashlib
+import sqlite3
+import select
+import struct
+import errno
+import ctypes, ctypes.util
+import threading
 import subprocess
 import tempfile
+import urllib.parse
+import zlib
 import xmltodict
 import argparse, traceback
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 import lxml.etree as ET
-from PyQt5 import QtCore, QtGui, QtWidgets, uic
-from PyQt5.uic import loadUi
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtWidgets import QApplication, QFileDialog, QListWidgetItem, QMessageBox, QDialog
 from PyQt5.QtGui import QColor, QStandardItemModel, QStandardItem
 from PyQt5.QtCore import ( Qt, QDate, QUrl, QModelIndex, QItemSelectionModel, QObject, pyqtSignal, QRunnable,
-                         pyqtSlot, QThreadPool)
+                         pyqtSlot, QThreadPool, QTimer, QSortFilterProxyModel)
 from tmdbv3api import *
 from tmdbv3api.exceptions import TMDbException
 
 import pprint
 
-qt_creator_file = sys.path[0] + "/ui/main_window.ui"
-Ui_MainWindow, QtBaseClass = uic.loadUiType(qt_creator_file)
+ui_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ui')
 '''
 Thread support
 '''
@@ -82,7 +99,7 @@ class Worker(QRunnable):
         if self.kwargs['progress_callback']:
             self.kwargs['progress_callback'] = self.signals.progress
         else:
-            print ("No progress callback")
+            log.debug("No progress callback")
 
 
     @pyqtSlot()
@@ -95,7 +112,7 @@ class Worker(QRunnable):
         try:
             result = self.fn(*self.args, **self.kwargs)
         except:
-            traceback.print_exc()
+            log.exception(f"{getattr(self.fn, '__name__', self.fn)} failed")
             exctype, value = sys.exc_info()[:2]
             self.signals.error.emit((exctype, value, traceback.format_exc()))
         else:
@@ -103,12 +120,987 @@ class Worker(QRunnable):
         finally:
             self.signals.finished.emit()  # Done
 
+#
+# Logging. Diagnostics go through the tagmkv logger at the level given with --log, one line per event with any extra
+# fields (log.info(..., extra=log_fields(file=..., seconds=...))) appended as key=value, or one JSON object per line
+# with --log-format json for log collectors.
+#
+log = logging.getLogger('tagmkv')
+
+def log_fields(**fields):
+    return {'fields': fields}
+
+class LogFormatter(logging.Formatter):
+    def __init__(self, json_lines=False):
+        super(LogFormatter, self).__init__('%(asctime)s %(levelname)s %(message)s')
+        self.json_lines = json_lines
+
+    def format(self, record):
+        fields = getattr(record, 'fields', {})
+        if self.json_lines:
+            entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                     'message': record.getMessage()}
+            entry.update(fields)
+            if record.exc_info:
+                entry['exception'] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str)
+        line = super(LogFormatter, self).format(record)
+        for name, value in fields.items():
+            value = f"{value:.6f}" if isinstance(value, float) else str(value)
+            line += f" {name}={json.dumps(value) if not value or ' ' in value or '=' in value else value}"
+        return line
+
+def setup_logging(level='INFO', log_format='text'):
+    handler = logging.StreamHandler()
+    handler.setFormatter(LogFormatter(json_lines=log_format == 'json'))
+    log.handlers[:] = [handler]
+    log.setLevel(level)
+    log.propagate = False
+
+# --log, the level name in any case.
+def log_level(name):
+    level = name.upper()
+    if not isinstance(logging.getLevelName(level), int):
+        raise argparse.ArgumentTypeError(f"unknown log level {name}")
+    return level
+
+#
+# Counters, timers and gauges for the expensive parts: subprocesses, reading and writing tags, TMDb requests, the
+# caches and files loaded and saved. Names follow the Prometheus conventions (_total counters, _seconds timers) and
+# labels are keyword arguments. export() writes a JSON file, or the Prometheus text format when the name ends in
+# .prom (for node_exporter's textfile collector).
+#
+class Metrics():
+    prefix = 'tagmkv_'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = collections.Counter()
+        # key -> [count, total seconds, slowest]
+        self.timers = {}
+        self.gauges = {}
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def count(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[self.key(name, labels)] += value
+
+    def observe(self, name, seconds, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    #
+    # The TMDb session and cache keep their own counts (see their stats()), they are read in here along with the
+    # cache hit ratios.
+    #
+    def collect(self):
+        counters = collections.Counter(self.counters)
+        timers = {key: list(timer) for key, timer in self.timers.items()}
+        gauges = dict(self.gauges)
+        if _tmdb_cache is not None:
+            for endpoint, counts in _tmdb_cache.stats().items():
+                for result, value in (('hit', counts['hits']), ('miss', counts['misses'])):
+                    counters[self.key('cache_lookups_total', {'cache': 'tmdb', 'endpoint': endpoint,
+                                                              'result': result})] = value
+        if _tmdb_session is not None:
+            stats = _tmdb_session.stats()
+            timers[self.key('tmdb_request_seconds', {})] = [stats['requests'], stats['latency_total'],
+                                                           stats['latency_max']]
+            counters[self.key('tmdb_request_failures_total', {})] = stats['failures']
+            counters[self.key('tmdb_retries_total', {})] = stats['retried']
+            counters[self.key('tmdb_throttled_total', {})] = stats['throttled']
+            counters[self.key('tmdb_rate_limit_wait_seconds_total', {})] = stats['limiter_wait']
+        lookups = collections.defaultdict(lambda: [0, 0])
+        for (name, labels), value in counters.items():
+            if name == 'cache_lookups_total':
+                labels = dict(labels)
+                lookups[labels['cache']][labels['result'] != 'hit'] += value
+        for cache, (hits, misses) in lookups.items():
+            gauges[self.key('cache_hit_ratio', {'cache': cache})] = hits / (hits + misses) if hits + misses else 0.0
+        gauges[self.key('uptime_seconds', {})] = time.time() - self.started
+        return counters, timers, gauges
+
+    def snapshot(self):
+        with self.lock:
+            counters, timers, gauges = self.collect()
+        return {
+            'started': self.started,
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in sorted(counters.items())],
+            'timers': [{'name': name, 'labels': dict(labels), 'count': count, 'total': total, 'max': slowest,
+                        'mean': total / count if count else 0.0}
+                       for (name, labels), (count, total, slowest) in sorted(timers.items())],
+            'gauges': [{'name': name, 'labels': dict(labels), 'value': value}
+                       for (name, labels), value in sorted(gauges.items())],
+        }
+
+    @staticmethod
+    def escape(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @classmethod
+    def prometheus_name(cls, name, labels, suffix=''):
+        name = cls.prefix + name + suffix
+        if labels:
+            name += '{' + ','.join(f'{label}="{cls.escape(value)}"' for label, value in labels) + '}'
+        return name
+
+    def prometheus(self):
+        with self.lock:
+            counters, timers, gauges = self.collect()
+        lines = []
+        def family(entries, kind, sample):
+            typed = set()
+            for (name, labels), value in sorted(entries.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {self.prefix}{name} {kind}")
+                sample(name, labels, value)
+        family(counters, 'counter', lambda name, labels, value:
+               lines.append(f"{self.prometheus_name(name, labels)} {value}"))
+        def timer_sample(name, labels, timer):
+            lines.append(f"{self.prometheus_name(name, labels, '_count')} {timer[0]}")
+            lines.append(f"{self.prometheus_name(name, labels, '_sum')} {timer[1]}")
+        family(timers, 'summary', timer_sample)
+        family({(name + '_max', labels): timer[2] for (name, labels), timer in timers.items()}, 'gauge',
+               lambda name, labels, value: lines.append(f"{self.prometheus_name(name, labels)} {value}"))
+        family(gauges, 'gauge', lambda name, labels, value:
+               lines.append(f"{self.prometheus_name(name, labels)} {value}"))
+        return '\n'.join(lines) + '\n'
+
+    # Written to a temporary file and renamed, whatever reads the file never sees half of it.
+    def export(self, path):
+        if path.endswith('.prom'):
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.snapshot(), indent=2)
+        directory = os.path.dirname(os.path.abspath(path))
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.metrics', delete=False) as out:
+                out.write(text)
+            os.replace(out.name, path)
+        except OSError as Err:
+            log.warning(f"Unable to write metrics to {path}: {Err}")
+
+_metrics = Metrics()
+def metrics():
+    return _metrics
+
+#
+# Where we keep our caches, follows the XDG layout ($XDG_CACHE_HOME/tagmkv or ~/.cache/tagmkv)
+#
+def user_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'tagmkv')
+
+#
+# On disk cache of the global tags extracted from a file. Entries are keyed by path and are only used when the size,
+# mtime and inode still match, so a file that hasn't been touched since the last session never needs mkvextract run
+# over it again.
+#
+class TagCache():
+    schema_version = 1
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(user_cache_dir(), 'tags.sqlite')
+        self.lock = threading.Lock()
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            if self.db.execute('PRAGMA user_version').fetchone()[0] != self.schema_version:
+                self.db.execute('DROP TABLE IF EXISTS tags')
+                self.db.execute(f"PRAGMA user_version = {self.schema_version}")
+            self.db.execute('CREATE TABLE IF NOT EXISTS tags (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, '
+                            'inode INTEGER, tags TEXT)')
+            self.db.commit()
+        except (OSError, sqlite3.Error) as Err:
+            log.warning(f"Tag cache disabled: {Err}")
+            self.db = None
+
+    @staticmethod
+    def file_key(file):
+        st = os.stat(file)
+        return os.path.realpath(file), st.st_size, st.st_mtime_ns, st.st_ino
+
+    def get(self, file):
+        if self.db is None:
+            return None
+        try:
+            path, size, mtime, inode = self.file_key(file)
+            with self.lock:
+                row = self.db.execute('SELECT size, mtime, inode, tags FROM tags WHERE path = ?', (path,)).fetchone()
+        except (OSError, sqlite3.Error) as Err:
+            log.warning(f"Tag cache lookup failed for {file}: {Err}")
+            return None
+        if row and tuple(row[:3]) == (size, mtime, inode):
+            metrics().count('cache_lookups_total', cache='tag', result='hit')
+            return json.loads(row[3])
+        metrics().count('cache_lookups_total', cache='tag', result='miss')
+        return None
+
+    def put(self, file, tags):
+        if self.db is None:
+            return
+        try:
+            path, size, mtime, inode = self.file_key(file)
+            with self.lock:
+                self.db.execute('INSERT OR REPLACE INTO tags (path, size, mtime, inode, tags) VALUES (?, ?, ?, ?, ?)',
+                                (path, size, mtime, inode, json.dumps(tags)))
+                self.db.commit()
+        except (OSError, sqlite3.Error) as Err:
+            log.warning(f"Tag cache update failed for {file}: {Err}")
+
+    # Drop the entry for a file that has gone or can no longer be read.
+    def remove(self, file):
+        if self.db is None:
+            return
+        try:
+            with self.lock:
+                self.db.execute('DELETE FROM tags WHERE path = ?', (os.path.realpath(file),))
+                self.db.commit()
+        except sqlite3.Error as Err:
+            log.warning(f"Tag cache update failed for {file}: {Err}")
+
+_tag_cache = None
+_tag_cache_lock = threading.Lock()
+def tag_cache():
+    global _tag_cache
+    with _tag_cache_lock:
+        if _tag_cache is None:
+            _tag_cache = TagCache()
+        return _tag_cache
+
+#
+# TMDb response cache. tmdbv3api sends all its requests through the requests session we hand it (see setup_tmdb),
+# so the responses are cached there: an in memory LRU in front of a SQLite store in the user cache dir, with the time
+# to live depending on the endpoint. Shows and their seasons change as episodes air (a season fetched this week
+# doesn't list next week's episode), movies and episodes hardly ever do.
+#
+class TMDbCache():
+    schema_version = 1
+    # (endpoint, request path pattern, seconds to keep the response), the first match wins.
+    endpoints = [
+        ('search', re.compile(r'^/search/'), 24 * 3600),
+        ('episode', re.compile(r'^/tv/\d+/season/\d+/episode/\d+'), 7 * 24 * 3600),
+        ('season', re.compile(r'^/tv/\d+/season/\d+'), 12 * 3600),
+        ('tv', re.compile(r'^/tv/\d+'), 24 * 3600),
+        ('movie', re.compile(r'^/movie/\d+'), 7 * 24 * 3600),
+        ('configuration', re.compile(r'^/configuration'), 3 * 24 * 3600),
+        ('genre', re.compile(r'^/genre/'), 7 * 24 * 3600),
+    ]
+    default_ttl = 3600
+    # Responses kept in memory.
+    memory_size = 512
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(user_cache_dir(), 'tmdb.sqlite')
+        self.memory = collections.OrderedDict()
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self.lock = threading.Lock()
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            if self.db.execute('PRAGMA user_version').fetchone()[0] != self.schema_version:
+                self.db.execute('DROP TABLE IF EXISTS responses')
+                self.db.execute(f"PRAGMA user_version = {self.schema_version}")
+            self.db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, expires REAL, body TEXT)')
+            self.db.commit()
+        except (OSError, sqlite3.Error) as Err:
+            log.warning(f"TMDb disk cache disabled: {Err}")
+            self.db = None
+
+    #
+    # The cache key is the request path and parameters without the api key, parameters sorted so the same request
+    # always has the same key.
+    #
+    @staticmethod
+    def request_key(url):
+        parts = urllib.parse.urlsplit(url)
+        query = sorted((key, value) for key, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+                       if key != 'api_key')
+        return parts.path + '?' + urllib.parse.urlencode(query)
+
+    @classmethod
+    def endpoint(cls, url):
+        path = urllib.parse.urlsplit(url).path
+        # Strip the API version
+        path = path[path.find('/', 1):] if path.startswith('/3/') else path
+        for name, pattern, ttl in cls.endpoints:
+            if pattern.match(path):
+                return name, ttl
+        return 'other', cls.default_ttl
+
+    def get(self, url, offline=False):
+        key = self.request_key(url)
+        name, ttl = self.endpoint(url)
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is None and self.db is not None:
+                try:
+                    row = self.db.execute('SELECT expires, body FROM responses WHERE key = ?', (key,)).fetchone()
+                except sqlite3.Error as Err:
+                    # A locked or damaged cache is a miss, the request goes to TMDb.
+                    log.warning(f"TMDb cache lookup failed: {Err}")
+                    row = None
+                if row:
+                    entry = tuple(row)
+                    self.remember(key, entry)
+            if entry is not None and (offline or entry[0] > now):
+                self.memory.move_to_end(key)
+                self.hits[name] += 1
+                return entry[1]
+            self.misses[name] += 1
+        return None
+
+    def put(self, url, body):
+        key = self.request_key(url)
+        name, ttl = self.endpoint(url)
+        entry = (time.time() + ttl, body)
+        with self.lock:
+            self.remember(key, entry)
+            if self.db is not None:
+                try:
+                    self.db.execute('INSERT OR REPLACE INTO responses (key, expires, body) VALUES (?, ?, ?)',
+                                    (key,) + entry)
+                    self.db.commit()
+                except sqlite3.Error as Err:
+                    log.warning(f"TMDb cache update failed: {Err}")
+
+    def remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {name: {'hits': self.hits[name], 'misses': self.misses[name]}
+                    for name in sorted(set(self.hits) | set(self.misses))}
+
+    def print_stats(self):
+        for name, counts in self.stats().items():
+            total = counts['hits'] + counts['misses']
+            print (f"TMDb cache {name}: {counts['hits']}/{total} hits")
+
+#
+# Token bucket, acquire() blocks until a request may be made. rate requests a second on average with bursts of up
+# to burst requests.
+#
+class RateLimiter():
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+#
+# The requests session tmdbv3api uses, answers GET requests from the TMDbCache when it can. With offline set
+# nothing goes to the network, anything not in the cache fails as a TMDbException. Requests that do go to the
+# network share a pool of keep-alive connections, are rate limited (cache hits are free) and are retried with
+# backoff when TMDb throttles (429, honouring Retry-After) or has a server error.
+#
+class TMDbSession(requests.Session):
+    offline = False
+    # Requests a second, TMDb starts answering 429 somewhere around 40.
+    rate = 20
+    burst = 20
+    pool_size = 16
+    retries = 5
+    backoff = 0.5
+    timeout = 30
+
+    def __init__(self, cache=None, rate=None):
+        super(TMDbSession, self).__init__()
+        self.cache = cache
+        self.limiter = RateLimiter(rate or self.rate, self.burst)
+        retry = Retry(total=self.retries, backoff_factor=self.backoff, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET']), respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.pool_size, max_retries=retry)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.counters_lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.limiter_wait = 0.0
+        self.retried = 0
+        self.throttled = 0
+
+    @staticmethod
+    def json_response(url, body, status_code=200):
+        response = requests.Response()
+        response.status_code = status_code
+        response.url = url
+        response.encoding = 'utf-8'
+        response.headers['Content-Type'] = 'application/json;charset=utf-8'
+        response._content = body.encode('utf-8')
+        return response
+
+    # A request that has to go to the network.
+    def send_request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        started = time.monotonic()
+        self.limiter.acquire()
+        sent = time.monotonic()
+        try:
+            response = super(TMDbSession, self).request(method, url, *args, **kwargs)
+        except requests.RequestException as Err:
+            with self.counters_lock:
+                self.failures += 1
+            log.warning(f"TMDb request failed: {Err}", extra=log_fields(path=TMDbCache.request_key(url)))
+            raise
+        latency = time.monotonic() - sent
+        history = getattr(getattr(response.raw, 'retries', None), 'history', None) or ()
+        with self.counters_lock:
+            self.requests += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+            self.limiter_wait += sent - started
+            self.retried += len(history)
+            self.throttled += sum(1 for attempt in history if attempt.status == 429)
+            if response.status_code != 200:
+                self.failures += 1
+        log.debug('TMDb request', extra=log_fields(path=TMDbCache.request_key(url), status=response.status_code,
+                                                   seconds=latency, retries=len(history)))
+        return response
+
+    def request(self, method, url, *args, **kwargs):
+        if method.upper() != 'GET' or self.cache is None:
+            return self.send_request(method, url, *args, **kwargs)
+        body = self.cache.get(url, offline=self.offline)
+        if body is not None:
+            return self.json_response(url, body)
+        if self.offline:
+            path = self.cache.request_key(url)
+            return self.json_response(url, json.dumps({'success': False, 'status_message': f"offline and {path} is not cached"}), 404)
+        response = self.send_request(method, url, *args, **kwargs)
+        if response.status_code == 200:
+            self.cache.put(url, response.text)
+        return response
+
+    def stats(self):
+        with self.counters_lock:
+            return {'requests': self.requests, 'failures': self.failures, 'retried': self.retried,
+                    'throttled': self.throttled, 'latency_total': self.latency_total,
+                    'latency_max': self.latency_max, 'limiter_wait': self.limiter_wait}
+
+    def print_stats(self):
+        stats = self.stats()
+        if not stats['requests']:
+            return
+        print (f"TMDb requests: {stats['requests']} ({stats['failures']} failed), "
+               f"{stats['latency_total'] / stats['requests'] * 1000:.0f}ms average, "
+               f"{stats['latency_max'] * 1000:.0f}ms slowest")
+        print (f"TMDb throttling: {stats['retried']} retries ({stats['throttled']} for 429), "
+               f"{stats['limiter_wait']:.1f}s waiting on the rate limiter")
+
+_tmdb_cache = None
+_tmdb = None
+_tmdb_session = None
+_tmdb_lock = threading.Lock()
+def tmdb_cache():
+    global _tmdb_cache
+    with _tmdb_lock:
+        if _tmdb_cache is None:
+            _tmdb_cache = TMDbCache()
+        return _tmdb_cache
+
+#
+# Set up tmdbv3api to go through our cached session. The session is shared by every TMDb object created after this.
+#
+def setup_tmdb():
+    global _tmdb, _tmdb_session
+    cache = tmdb_cache()
+    with _tmdb_lock:
+        if _tmdb is None:
+            _tmdb_session = TMDbSession(cache)
+            _tmdb = TMDb(obj_cached=False, session=_tmdb_session)
+            # tmdbv3api's own request cache bypasses the session.
+            _tmdb.cache = False
+            _tmdb.language = "en"
+            if TMDbSession.offline and not _tmdb.api_key:
+                # Not used, but tmdbv3api won't make a request without one.
+                _tmdb.api_key = 'offline'
+        return _tmdb
+
+def tmdb_session():
+    setup_tmdb()
+    return _tmdb_session
+
+#
+# Episode details for a whole season from one request, keyed by episode number. Every file from the same season is
+# filled from the one response instead of asking for each episode in turn. The episodes come back in the same form
+# as Episode().details(..., append_to_response="credits"): the season's cast plus the episode's own crew.
+# The response is kept by the TMDbCache (and expires with it, seasons grow as they air). Threads asking for a season
+# that is already being fetched wait for that request rather than making their own.
+#
+_season_requests = {}
+_season_requests_lock = threading.Lock()
+def season_episodes(show_id, season_number):
+    key = (show_id, season_number)
+    with _season_requests_lock:
+        request = _season_requests.get(key)
+        if request is not None:
+            fetching = False
+        else:
+            fetching = True
+            request = _season_requests[key] = Future()
+    if not fetching:
+        return request.result()
+    try:
+        season = Season().details(show_id, season_number, append_to_response="credits")
+        episodes = {}
+        for episode in season['episodes']:
+            episodes[int(episode['episode_number'])] = {
+                'name': episode['name'], 'overview': episode['overview'], 'air_date': episode['air_date'],
+                'credits': {'cast': season['credits']['cast'], 'crew': episode['crew']}}
+    except Exception as Err:
+        request.set_exception(Err)
+        raise
+    else:
+        request.set_result(episodes)
+        return episodes
+    finally:
+        with _season_requests_lock:
+            del _season_requests[key]
+
+#
+# Daily shows are named by air date. Their episodes are in the last season (specials aside) to have started airing
+# by that date, from the seasons listed in the show's details. None when no season had.
+#
+def air_date_season(show, air_date):
+    started = [(season['air_date'], season['season_number']) for season in show.get('seasons') or []
+               if season['season_number'] and season.get('air_date') and season['air_date'] <= air_date]
+    return max(started)[1] if started else None
+
+#
+# TMDb answers a request for something it doesn't have (a bad id, a season it doesn't list) with a 404 and one of
+# these messages. Asking again won't change that, unlike a failed request. (--offline misses say "not cached".)
+#
+tmdb_not_found_rx = re.compile(r'not (be )?found', re.IGNORECASE)
+def tmdb_not_found(err):
+    return isinstance(err, TMDbException) and bool(tmdb_not_found_rx.search(str(err)))
+
+#
+# Posters shown in the search results dialog, kept on disk in the user cache dir so going back over results (or
+# looking the same show up again) doesn't download them again. Files are named after a hash of the url; once the
+# cache grows past max_size the least recently used posters are removed.
+#
+class PosterCache():
+    max_size = 100 * 1024 * 1024
+    timeout = 30
+
+    def __init__(self, path=None, max_size=None):
+        self.path = path or os.path.join(user_cache_dir(), 'posters')
+        self.max_size = max_size or self.max_size
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=8))
+        self.size = None
+        try:
+            os.makedirs(self.path, exist_ok=True)
+        except OSError as Err:
+            log.warning(f"Poster cache disabled, can't create {self.path}: {Err}")
+            self.path = None
+
+    def file_name(self, url):
+        extension = os.path.splitext(urllib.parse.urlsplit(url).path)[1] or '.jpg'
+        return os.path.join(self.path, hashlib.sha1(url.encode('utf-8')).hexdigest() + extension)
+
+    # The local copy of url, or None if it hasn't been fetched.
+    def get(self, url):
+        if self.path is None:
+            return None
+        name = self.file_name(url)
+        try:
+            # The mtime is the last use, for eviction.
+            os.utime(name)
+        except OSError:
+            metrics().count('cache_lookups_total', cache='poster', result='miss')
+            return None
+        metrics().count('cache_lookups_total', cache='poster', result='hit')
+        return name
+
+    # Download url into the cache, for urls get() didn't have. Returns the local copy or None if it couldn't be
+    # fetched.
+    def download(self, url):
+        if self.path is None:
+            return None
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as Err:
+            log.warning(f"Failed to fetch poster {url}: {Err}")
+            return None
+        name = self.file_name(url)
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.path, delete=False) as out:
+                out.write(response.content)
+            os.replace(out.name, name)
+        except OSError as Err:
+            log.warning(f"Failed to cache poster {url}: {Err}")
+            return None
+        self.added(len(response.content))
+        return name
+
+    def entries(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def added(self, size):
+        with self.lock:
+            if self.size is None:
+                self.size = sum(entry[1] for entry in self.entries())
+            else:
+                self.size += size
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        entries = sorted(self.entries())
+        self.size = sum(entry[1] for entry in entries)
+        # Down to 90% so every new poster doesn't trigger another scan.
+        while entries and self.size > self.max_size * 0.9:
+            mtime, size, name = entries.pop(0)
+            try:
+                os.remove(name)
+                self.size -= size
+            except OSError:
+                pass
+
+_poster_cache = None
+_poster_cache_lock = threading.Lock()
+def poster_cache():
+    global _poster_cache
+    with _poster_cache_lock:
+        if _poster_cache is None:
+            _poster_cache = PosterCache()
+        return _poster_cache
+
+#
+# Reference data from TMDb that hardly ever changes (the genre lists and the API configuration), kept in the user
+# cache dir so the UI has it the moment it starts. Entries are plain JSON with a time to live; an expired entry is
+# still returned, marked stale, until the background refresh replaces it.
+#
+class ReferenceStore():
+    schema_version = 1
+    ttls = {
+        'tv_genres': 7 * 24 * 3600,
+        'movie_genres': 7 * 24 * 3600,
+        'configuration': 3 * 24 * 3600,
+    }
+    default_ttl = 24 * 3600
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(user_cache_dir(), 'reference.sqlite')
+        self.lock = threading.Lock()
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            if self.db.execute('PRAGMA user_version').fetchone()[0] != self.schema_version:
+                self.db.execute('DROP TABLE IF EXISTS reference')
+                self.db.execute(f"PRAGMA user_version = {self.schema_version}")
+            self.db.execute('CREATE TABLE IF NOT EXISTS reference (name TEXT PRIMARY KEY, expires REAL, data TEXT)')
+            self.db.commit()
+        except (OSError, sqlite3.Error) as Err:
+            log.warning(f"Reference data store disabled: {Err}")
+            self.db = None
+
+    # (data, fresh), data is None if name has never been stored.
+    def get(self, name):
+        if self.db is None:
+            return None, False
+        try:
+            with self.lock:
+                row = self.db.execute('SELECT expires, data FROM reference WHERE name = ?', (name,)).fetchone()
+            if row is None:
+                return None, False
+            return json.loads(row[1]), row[0] > time.time()
+        except (sqlite3.Error, ValueError) as Err:
+            log.warning(f"Reference data {name} unreadable: {Err}")
+            return None, False
+
+    def put(self, name, data):
+        if self.db is None:
+            return
+        expires = time.time() + self.ttls.get(name, self.default_ttl)
+        try:
+            with self.lock:
+                self.db.execute('INSERT OR REPLACE INTO reference (name, expires, data) VALUES (?, ?, ?)',
+                                (name, expires, json.dumps(data)))
+                self.db.commit()
+        except sqlite3.Error as Err:
+            log.warning(f"Reference data {name} not saved: {Err}")
+
+    # Fetch every entry that is missing or expired, returns {name: data} for the ones refreshed.
+    def refresh(self, fetchers):
+        refreshed = {}
+        for name, fetch in fetchers.items():
+            data, fresh = self.get(name)
+            if fresh:
+                continue
+            try:
+                data = fetch()
+            except (TMDbException, requests.RequestException) as Err:
+                log.warning(f"Failed to refresh {name}: {Err}")
+                continue
+            self.put(name, data)
+            refreshed[name] = data
+        return refreshed
+
+_reference_store = None
+_reference_store_lock = threading.Lock()
+def reference_store():
+    global _reference_store
+    with _reference_store_lock:
+        if _reference_store is None:
+            _reference_store = ReferenceStore()
+        return _reference_store
+
+# The fetchers for ReferenceStore.refresh, the raw response JSON rather than tmdbv3api's wrapper objects.
+def tmdb_reference_fetchers():
+    return {
+        'configuration': lambda: Configuration().info()._json,
+        'tv_genres': lambda: Genre().tv_list()._json['genres'],
+        'movie_genres': lambda: Genre().movie_list()._json['genres'],
+    }
+
+#
+# The outcome of auto matching one file. status is one of
+#   matched    details holds the show (episodes prefetched) or movie details to fill the file from
+#   ambiguous  no candidate is good enough on its own, candidates needs a human to pick one
+#   none       nothing found
+#   missing    TMDb doesn't have the show's season (or the show), see error. Not worth asking again
+#   error      the lookup failed, see error
+# candidates is a list of (score, search result) best first.
+#
+class AutoMatch():
+    def __init__(self, mediafile, status, candidates=None, details=None, error=None):
+        self.mediafile = mediafile
+        self.status = status
+        self.candidates = candidates or []
+        self.details = details
+        self.error = error
+
+    # Fill the file from a match, runs on the GUI (or main) thread.
+    def fill(self):
+        if int(self.mediafile.metadata['tags']['media_type']) == 10:
+            return self.mediafile.fill_show_episode(self.details)
+        self.mediafile.fill_movie_tags(self.details)
+        return True
+
+#
+# Match files to TMDb without asking. The search results are scored on title similarity plus how well the release
+# year agrees with the year in the file name (parse_filename has already taken the year and the resolution out of
+# the title). A match is accepted when the best score reaches threshold and is clear of the runner up by margin,
+# anything else is left for review. With threshold None only a lone search result is accepted, like the lookup
+# dialog does. Lookups run on jobs threads, the TMDbSession keeps them under TMDb's rate limit.
+#
+class AutoMatcher():
+    threshold = 0.85
+    margin = 0.1
+    jobs = 4
+
+    def __init__(self, threshold=threshold, jobs=None):
+        self.threshold = threshold
+        self.jobs = jobs or self.jobs
+
+    @staticmethod
+    def normalize(title):
+        title = title.lower().replace('&', ' and ')
+        title = ' '.join(re.sub(r"[^\w]+", ' ', title).split())
+        if title.startswith('the '):
+            title = title[4:]
+        return title
+
+    @staticmethod
+    def result_field(result, name):
+        return result[name] if name in result and result[name] else None
+
+    def score(self, mediafile, result, tv):
+        tags = mediafile.metadata['tags']
+        term = self.normalize(tags['show'] if tv else tags['title'])
+        names = [self.result_field(result, key) for key in ('title', 'original_title', 'name', 'original_name')]
+        score = max((difflib.SequenceMatcher(None, term, self.normalize(name)).ratio() for name in names if name),
+                    default=0.0)
+        year = mediafile.metadata.get('filename_year')
+        date = self.result_field(result, 'first_air_date' if tv else 'release_date') or ''
+        if year and date[:4].isdigit():
+            difference = abs(year - int(date[:4]))
+            if difference == 0:
+                score += 0.15
+            elif difference == 1:
+                score += 0.05
+            elif not tv:
+                # A show's first air date can be years before the episode, only a movie's year can disagree.
+                score -= 0.3
+        return max(0.0, min(1.0, score))
+
+    def rank(self, mediafile, results, tv):
+        candidates = [(self.score(mediafile, result, tv), result) for result in results]
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        return candidates
+
+    def confident(self, candidates):
+        if self.threshold is None:
+            return len(candidates) == 1
+        best = candidates[0][0]
+        if best < self.threshold:
+            return False
+        return len(candidates) == 1 or best - candidates[1][0] >= self.margin
+
+    def match(self, mediafile):
+        tags = mediafile.metadata['tags']
+        tv = int(tags['media_type']) == 10
+        try:
+            if tv:
+                results = TV().search(tags['show'])
+            else:
+                results = Search().movies(tags['title'], adult = True)
+            if results['total_results'] == 0 or len(results) == 0:
+                return AutoMatch(mediafile, 'none')
+            candidates = self.rank(mediafile, list(results), tv)
+            if not self.confident(candidates):
+                return AutoMatch(mediafile, 'ambiguous', candidates)
+            tmdb_id = candidates[0][1]['id']
+            if tv:
+                details = TV().details(tmdb_id)
+                season = mediafile.show_season(details)
+                if season is not None:
+                    season_episodes(details['id'], season)
+            else:
+                details = Movie().details(tmdb_id, append_to_response='credits')
+        except (TMDbException, requests.RequestException) as Err:
+            if tmdb_not_found(Err):
+                return AutoMatch(mediafile, 'missing', candidates, error=str(Err))
+            return AutoMatch(mediafile, 'error', error=str(Err))
+        return AutoMatch(mediafile, 'matched', candidates, details)
+
+    # AutoMatch results for mediafiles in the order they complete.
+    def match_all(self, mediafiles):
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            for future in as_completed([pool.submit(self.match, mediafile) for mediafile in mediafiles]):
+                yield future.result()
+
+#
+# The Qt Designer forms in ui/ are only compiled when a window first needs them. The generated python is cached in
+# the user cache dir (keyed on a hash of the .ui file and the PyQt version) and the form class is kept for the rest
+# of the session, so importing this module never touches uic and opening a dialog again doesn't re-parse its XML.
+#
+# The cached source is executed, so it is only used from a directory only we can write to, from a file we own that
+# nobody else can write. Anything else is ignored and the form compiled afresh.
+#
+_ui_forms = {}
+_ui_forms_lock = threading.Lock()
+def ui_form(name):
+    with _ui_forms_lock:
+        if name not in _ui_forms:
+            _ui_forms[name] = compile_ui_form(name)
+        return _ui_forms[name]
+
+def private_path(path):
+    st = os.lstat(path)
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022 and not os.path.islink(path)
+
+def compile_ui_form(name):
+    ui_file = os.path.join(ui_dir, name + '.ui')
+    with open(ui_file, 'rb') as f:
+        digest = hashlib.sha256(f.read() + QtCore.PYQT_VERSION_STR.encode('utf-8')).hexdigest()
+    cache_dir = os.path.join(user_cache_dir(), 'ui')
+    cache_file = os.path.join(cache_dir, f"{name}-{digest}.py")
+    source = None
+    try:
+        if private_path(cache_dir) and private_path(cache_file):
+            with open(cache_file) as f:
+                source = f.read()
+        else:
+            log.warning(f"Ignoring {cache_file}, it can be written by other users")
+    except OSError:
+        pass
+    if source is None:
+        from PyQt5 import uic
+        code = io.StringIO()
+        uic.compileUi(ui_file, code)
+        source = code.getvalue()
+        try:
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+            if private_path(cache_dir):
+                fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+                with os.fdopen(fd, 'w') as f:
+                    f.write(source)
+                os.replace(tmp_file, cache_file)
+        except OSError as Err:
+            log.warning(f"Unable to cache compiled {name}.ui: {Err}")
+    namespace = {}
+    exec(compile(source, cache_file, 'exec'), namespace)
+    return next(value for key, value in namespace.items() if key.startswith('Ui_'))
+
+# Build the named form on widget, the form's child widgets become attributes of widget.
+def setup_ui(widget, name):
+    form = ui_form(name)()
+    form.setupUi(widget)
+    widget.__dict__.update(form.__dict__)
+
 #
 # class to handle the XML properties for tagging
 #
+#
+# A library can hold millions of these, so no per instance __dict__. Tag names and short values (the people and
+# characters that repeat on every episode of a show) are interned so each distinct string is only stored once.
+#
 class Property():
+    __slots__ = ('name', 'value', 'child')
+    # Longer values are summaries and the like, never shared between files.
+    intern_length = 64
+
     def __init__(self, name, value):
-        self.name = name
+        self.name = sys.intern(name)
+        if isinstance(value, str) and len(value) <= self.intern_length:
+            value = sys.intern(value)
         self.value = value
         self.child = None
 
@@ -128,15 +1120,501 @@ class Property():
     def __eq__(self, other):
         return self.__hash__() == other.__hash__()
 
+#
+# Minimal Matroska/EBML support. Just enough to find the level 1 elements through the SeekHead, read the global tags
+# straight out of the file without running mkvextract and rewrite the tags and title in place. Only the SeekHead, the
+# Tags and Info elements and the headers of the elements in front of the first Cluster are read, never the whole
+# container.
+# See https://www.matroska.org/technical/elements.html
+#
+class EBMLError(Exception):
+    pass
+
+class MatroskaFile():
+    EBML = 0x1A45DFA3
+    SEGMENT = 0x18538067
+    SEEK_HEAD = 0x114D9B74
+    SEEK = 0x4DBB
+    SEEK_ID = 0x53AB
+    SEEK_POSITION = 0x53AC
+    INFO = 0x1549A966
+    TITLE = 0x7BA9
+    CLUSTER = 0x1F43B675
+    TAGS = 0x1254C367
+    TAG = 0x7373
+    TARGETS = 0x63C0
+    TARGET_TYPE_VALUE = 0x68CA
+    TARGET_UIDS = (0x63C5, 0x63C9, 0x63C4, 0x63C6)   # Track, Edition, Chapter and Attachment UIDs
+    SIMPLE_TAG = 0x67C8
+    TAG_NAME = 0x45A3
+    TAG_STRING = 0x4487
+    VOID = 0xEC
+    CRC32 = 0xBF
+    # Element size used for "unknown size"
+    UNKNOWN_SIZE = -1
+    # Refuse to load anything bigger than this into memory, the file is probably damaged.
+    max_element_size = 16 * 1024 * 1024
+    # Void padding left after the Tags when we have to grow them at the end of the file, room for the next edit.
+    tags_padding = 4096
+
+    def __init__(self, file, mode='rb'):
+        self.file = file
+        self.fh = open(file, mode)
+        self.file_size = os.fstat(self.fh.fileno()).st_size
+        # Offset of the Segment data, SeekHead positions are relative to it.
+        self.segment_offset = None
+        self.segment_size = None
+        self.segment_start = None
+        self.segment_end = None
+        self.seek_head_found = False
+        # Level 1 elements we know about, element id -> [(offset, header size, data size), ...]
+        self.elements = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.fh.close()
+
+    #
+    # EBML variable length integers, ids keep their length marker bits, sizes don't.
+    #
+    @staticmethod
+    def read_vint(data, pos, keep_marker=False):
+        if pos >= len(data):
+            raise EBMLError("Truncated element")
+        first = data[pos]
+        length = 1
+        mask = 0x80
+        while length <= 8 and not first & mask:
+            length += 1
+            mask >>= 1
+        if length > 8 or pos + length > len(data):
+            raise EBMLError("Invalid variable length integer")
+        value = first if keep_marker else first & (mask - 1)
+        all_ones = (first & (mask - 1)) == mask - 1
+        for byte in data[pos + 1:pos + length]:
+            value = (value << 8) | byte
+            all_ones = all_ones and byte == 0xff
+        if all_ones and not keep_marker:
+            value = MatroskaFile.UNKNOWN_SIZE
+        return value, length
+
+    @staticmethod
+    def read_uint(data):
+        return int.from_bytes(data, 'big') if data else 0
+
+    @staticmethod
+    def read_string(data):
+        return bytes(data).rstrip(b'\0').decode('utf-8', errors='replace')
+
+    # (id, header size, data size) of the element starting at offset in the file
+    def read_header(self, offset):
+        self.fh.seek(offset)
+        data = self.fh.read(12)
+        element_id, id_length = self.read_vint(data, 0, keep_marker=True)
+        size, size_length = self.read_vint(data, id_length)
+        return element_id, id_length + size_length, size
+
+    def read_data(self, offset, header_size, size):
+        if size == self.UNKNOWN_SIZE or size > self.max_element_size:
+            raise EBMLError(f"Refusing to read element of size {size} at {offset}")
+        self.fh.seek(offset + header_size)
+        data = self.fh.read(size)
+        if len(data) != size:
+            raise EBMLError(f"Truncated element at {offset}")
+        return data
+
+    # Iterate over the (id, data, offset within buffer, header size) of the child elements in buffer.
+    @classmethod
+    def children(cls, data):
+        data = memoryview(data)
+        pos = 0
+        while pos < len(data):
+            element_id, id_length = cls.read_vint(data, pos, keep_marker=True)
+            size, size_length = cls.read_vint(data, pos + id_length)
+            start = pos + id_length + size_length
+            if size == cls.UNKNOWN_SIZE or start + size > len(data):
+                raise EBMLError("Child element overruns its parent")
+            yield element_id, data[start:start + size], pos, id_length + size_length
+            pos = start + size
+
+    def add_element(self, element_id, offset, header_size, size):
+        entry = (offset, header_size, size)
+        known = self.elements.setdefault(element_id, [])
+        if entry not in known:
+            known.append(entry)
+
+    def find(self, element_id):
+        known = self.elements.get(element_id)
+        return known[0] if known else None
+
+    def parse_seek_head(self, offset, header_size, size):
+        self.seek_head_found = True
+        targets = []
+        for seek_id, seek_data, _, _ in self.children(self.read_data(offset, header_size, size)):
+            if seek_id != self.SEEK:
+                continue
+            target_id = position = None
+            for child_id, child_data, _, _ in self.children(seek_data):
+                if child_id == self.SEEK_ID:
+                    target_id = self.read_uint(child_data)
+                elif child_id == self.SEEK_POSITION:
+                    position = self.read_uint(child_data)
+            if target_id is not None and position is not None:
+                targets.append((target_id, self.segment_start + position))
+        return targets
+
+    #
+    # Find the level 1 elements. Walks the element headers up to the first Cluster then follows the SeekHead(s) for
+    # anything stored after the clusters (mkvpropedit puts the Tags at the end of the file).
+    #
+    def scan(self):
+        if self.segment_start is not None:
+            return
+        element_id, header_size, size = self.read_header(0)
+        if element_id != self.EBML:
+            raise EBMLError(f"{self.file} is not a Matroska file")
+        offset = header_size + size
+        element_id, header_size, size = self.read_header(offset)
+        if element_id != self.SEGMENT:
+            raise EBMLError(f"No Segment in {self.file}")
+        self.segment_offset = offset
+        self.segment_size = size
+        self.segment_start = offset + header_size
+        if size == self.UNKNOWN_SIZE:
+            self.segment_end = self.file_size
+        else:
+            self.segment_end = min(self.segment_start + size, self.file_size)
+        seeks = []
+        offset = self.segment_start
+        while offset < self.segment_end:
+            element_id, header_size, size = self.read_header(offset)
+            if element_id == self.CLUSTER or size == self.UNKNOWN_SIZE:
+                break
+            self.add_element(element_id, offset, header_size, size)
+            if element_id == self.SEEK_HEAD:
+                seeks.extend(self.parse_seek_head(offset, header_size, size))
+            offset += header_size + size
+        seen = set()
+        while seeks:
+            target_id, offset = seeks.pop(0)
+            if offset in seen or offset >= self.segment_end:
+                continue
+            seen.add(offset)
+            element_id, header_size, size = self.read_header(offset)
+            if element_id != target_id:
+                log.warning(f"SeekHead entry for {target_id:X} in {self.file} points at {element_id:X}, ignored")
+                continue
+            self.add_element(element_id, offset, header_size, size)
+            if element_id == self.SEEK_HEAD:
+                seeks.extend(self.parse_seek_head(offset, header_size, size))
+
+    def decode_simple_tag(self, data):
+        name = string = None
+        children = []
+        for element_id, element_data, _, _ in self.children(data):
+            if element_id == self.TAG_NAME:
+                name = self.read_string(element_data)
+            elif element_id == self.TAG_STRING:
+                string = self.read_string(element_data)
+            elif element_id == self.SIMPLE_TAG:
+                children.append(self.decode_simple_tag(element_data))
+        return name, string, children
+
+    @classmethod
+    def is_global_tag(cls, tag_data):
+        for element_id, element_data, _, _ in cls.children(tag_data):
+            if element_id == cls.TARGETS:
+                for target_id, target_data, _, _ in cls.children(element_data):
+                    if target_id in cls.TARGET_UIDS and cls.read_uint(target_data) != 0:
+                        return False
+        return True
+
+    #
+    # The global SimpleTags in the file as a list of (name, string, [children]) tuples, the children are the nested
+    # SimpleTags in the same form. Returns None if we can't tell without scanning the whole file, in which case the
+    # caller should fall back to mkvextract.
+    #
+    def read_global_tags(self):
+        self.scan()
+        tags = self.find(self.TAGS)
+        if tags is None:
+            # A SeekHead without a Tags entry means there are no tags.
+            return [] if self.seek_head_found else None
+        simple_tags = []
+        for element_id, tag_data, _, _ in self.children(self.read_data(*tags)):
+            if element_id != self.TAG or not self.is_global_tag(tag_data):
+                continue
+            for child_id, child_data, _, _ in self.children(tag_data):
+                if child_id == self.SIMPLE_TAG:
+                    simple_tags.append(self.decode_simple_tag(child_data))
+        return simple_tags
+
+    #
+    # Encoding, the inverse of the read_* functions above.
+    #
+    @staticmethod
+    def encode_id(element_id):
+        return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big')
+
+    @staticmethod
+    def encode_size(size, width=1):
+        # All ones is reserved for "unknown size"
+        while size >= (1 << (7 * width)) - 1:
+            width += 1
+        if width > 8:
+            raise EBMLError(f"Element size {size} too large")
+        return ((1 << (7 * width)) | size).to_bytes(width, 'big')
+
+    @classmethod
+    def encode_element(cls, element_id, data, size_width=1):
+        return cls.encode_id(element_id) + cls.encode_size(len(data), size_width) + bytes(data)
+
+    @classmethod
+    def encode_uint(cls, element_id, value):
+        return cls.encode_element(element_id, value.to_bytes(max(1, (value.bit_length() + 7) // 8), 'big'))
+
+    @classmethod
+    def encode_string(cls, element_id, value):
+        return cls.encode_element(element_id, str(value).encode('utf-8'))
+
+    # A Void element exactly size bytes long (size must be at least 2)
+    @classmethod
+    def encode_void(cls, size):
+        width = 1 if size - 2 < 127 else 8
+        return cls.encode_element(cls.VOID, bytes(size - 1 - width), width)
+
+    @classmethod
+    def encode_simple_tag(cls, name, string, children=()):
+        data = cls.encode_string(cls.TAG_NAME, name) + cls.encode_string(cls.TAG_STRING, string)
+        for child in children:
+            data += cls.encode_simple_tag(*child)
+        return cls.encode_element(cls.SIMPLE_TAG, data)
+
+    # Children of a master element with the CRC-32 recalculated if the original had one.
+    @classmethod
+    def with_crc(cls, had_crc, data):
+        if had_crc:
+            crc = zlib.crc32(data).to_bytes(4, 'little')
+            return cls.encode_element(cls.CRC32, crc) + data
+        return data
+
+    #
+    # Encode the element so it takes exactly size bytes, padding with a Void element if it is smaller. Returns None if
+    # it won't fit.
+    #
+    @classmethod
+    def fit_element(cls, element_id, data, size):
+        element = cls.encode_element(element_id, data)
+        spare = size - len(element)
+        if spare == 1:
+            # Too small for a Void, use a wider size field instead.
+            width = len(cls.encode_size(len(data))) + 1
+            if width > 8:
+                return None
+            return cls.encode_element(element_id, data, width)
+        if spare == 0:
+            return element
+        if spare > 1:
+            return element + cls.encode_void(spare)
+        return None
+
+    # The space the level 1 element at offset can use, its own size plus any Void elements straight after it.
+    def available_space(self, offset, header_size, size):
+        end = offset + header_size + size
+        while end < self.segment_end:
+            try:
+                element_id, void_header, void_size = self.read_header(end)
+            except EBMLError:
+                break
+            if element_id != self.VOID or void_size == self.UNKNOWN_SIZE:
+                break
+            end += void_header + void_size
+        return min(end, self.segment_end) - offset
+
+    # New contents for the Tags element, the global tags replaced by simple_tags and any track, edition, chapter or
+    # attachment tags kept as they are.
+    def encode_tags(self, data, simple_tags):
+        had_crc = False
+        kept = b''
+        for element_id, tag_data, pos, header_size in self.children(data):
+            if element_id == self.CRC32:
+                had_crc = True
+            elif element_id != self.TAG or not self.is_global_tag(tag_data):
+                kept += bytes(data[pos:pos + header_size + len(tag_data)])
+        tag = self.encode_element(self.TARGETS, self.encode_uint(self.TARGET_TYPE_VALUE, 50))
+        for simple_tag in simple_tags:
+            tag += self.encode_simple_tag(*simple_tag)
+        return self.with_crc(had_crc, self.encode_element(self.TAG, tag) + kept)
+
+    # New contents for the Info element with the Title set to title.
+    def encode_info(self, data, title):
+        had_crc = False
+        info = b''
+        for element_id, element_data, pos, header_size in self.children(data):
+            if element_id == self.CRC32:
+                had_crc = True
+            elif element_id != self.TITLE:
+                info += bytes(data[pos:pos + header_size + len(element_data)])
+        info += self.encode_string(self.TITLE, title)
+        return self.with_crc(had_crc, info)
+
+    #
+    # Grow the element at offset, which must be the last thing in the file, to element. The Segment size is updated
+    # to match. Returns the writes to make or None if the Segment size can't be changed in place.
+    #
+    def grow_at_end(self, offset, space, element):
+        if offset + space != self.file_size or self.segment_end != self.file_size:
+            return None
+        element += self.encode_void(self.tags_padding)
+        if self.segment_size == self.UNKNOWN_SIZE:
+            return [(offset, element)]
+        id_length = len(self.encode_id(self.SEGMENT))
+        width = self.segment_start - self.segment_offset - id_length
+        try:
+            size = self.encode_size(self.segment_size + len(element) - space, width)
+        except EBMLError:
+            return None
+        if len(size) != width:
+            return None
+        return [(offset, element), (self.segment_offset + id_length, size)]
+
+    #
+    # Replace the global tags and the segment title in place. Both elements are rewritten into the space they, and
+    # any Void padding after them, already occupy so nothing else in the file moves. Tags at the end of the file
+    # (where mkvpropedit puts them) can also grow. Returns False without touching the file if either won't fit or
+    # the file has no Tags element yet, mkvpropedit has to rearrange the file then.
+    #
+    def write_tags_and_title(self, simple_tags, title):
+        self.scan()
+        if len(self.elements.get(self.TAGS, [])) != 1 or len(self.elements.get(self.INFO, [])) != 1:
+            return False
+        writes = []
+        for element_id in (self.INFO, self.TAGS):
+            offset, header_size, size = self.find(element_id)
+            data = self.read_data(offset, header_size, size)
+            if element_id == self.TAGS:
+                data = self.encode_tags(data, simple_tags)
+            else:
+                data = self.encode_info(data, title)
+            space = self.available_space(offset, header_size, size)
+            element = self.fit_element(element_id, data, space)
+            if element is not None:
+                writes.append((offset, element))
+                continue
+            grown = self.grow_at_end(offset, space, self.encode_element(element_id, data))
+            if grown is None:
+                return False
+            writes.extend(grown)
+        for offset, data in writes:
+            self.fh.seek(offset)
+            self.fh.write(data)
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        return True
+
+#
+# Pull what we can out of a file name: the show, season and episode(s) (S01E02, S01E01E02, S01E01-02, 1x02 or an air
+# date for daily shows) or else a movie title, plus the year and resolution. One pass of one compiled pattern finds
+# every marker in the name, the title is whatever comes before the first of them. No Qt, so the batch and watch
+# modes (and the benchmark) can use it on their own.
+#
+class FilenameParser():
+    token_rx = re.compile(r"""
+        (?P<sxe>\b[Ss](?P<sxe_season>\d{1,3})[ .-]?[Ee](?P<sxe_episode>\d{1,3})
+            (?P<sxe_more>(?:[ .-]?[Ee]\d{1,3}|-\d{1,3}(?![\dPpIi]))*)(?!\d))
+      | (?P<nxe>\b(?P<nxe_season>\d{1,2})[xX](?P<nxe_episode>\d{2,3})\b)
+      | (?P<date>\b(?P<date_year>(?:19|20)\d{2})[ .-](?P<date_month>0[1-9]|1[0-2])[ .-](?P<date_day>0[1-9]|[12]\d|3[01])\b)
+      | (?P<year>[(\[]?\b(?P<year_value>(?:19|20)\d{2})\b[)\]]?)
+      | (?P<resolution>\b(?P<resolution_value>\d{3,4}[PpIi]|4[Kk])\b)
+      | (?P<junk>\b(?:blu-?ray|bdrip|brrip|web-?rip|web-?dl|hdtv|dvdrip|x26[45]|[hH]\.?26[45]|hevc|remux|proper|repack)\b)
+        """, re.VERBOSE | re.IGNORECASE)
+    episode_rx = re.compile(r"\d+")
+    separator_rx = re.compile(r"[\s._]+")
+
+    def __init__(self):
+        self.this_year = datetime.date.today().year
+
+    def clean(self, text):
+        return self.separator_rx.sub(' ', text).strip(' -([').strip()
+
+    #
+    # {'title', 'year', 'resolution', 'container'} for a movie, plus {'show', 'season', 'episode', 'episodes',
+    # 'air_date'} when it looks like an episode. year and resolution are None when the name doesn't have them.
+    #
+    def parse(self, file_name):
+        name, container = os.path.splitext(file_name)
+        name = name.replace('_', ' ')
+        episode = None
+        years = []
+        resolution = None
+        # Where the title stops, the first year, resolution or release junk.
+        end = len(name)
+        for match in self.token_rx.finditer(name):
+            kind = match.lastgroup
+            if kind in ('sxe', 'nxe', 'date'):
+                if episode is None or (episode.lastgroup == 'date' and kind != 'date'):
+                    episode = match
+            elif kind == 'year':
+                year = int(match.group('year_value'))
+                # A year at the very start is the title (2001 A Space Odyssey).
+                if match.start() > 0 and 1900 < year <= self.this_year:
+                    years.append(match)
+            elif kind == 'resolution':
+                resolution = resolution or match.group('resolution_value').lower()
+                end = min(end, match.start())
+            else:
+                end = min(end, match.start())
+        parsed = {'container': container, 'resolution': resolution, 'year': None}
+        if episode is not None:
+            before = [year for year in years if year.start() < episode.start()]
+            after = [year for year in years if year.start() > episode.end()]
+            show_end = before[-1].start() if before else episode.start()
+            title_end = min([end] + [year.start() for year in after])
+            parsed['show'] = self.clean(name[:show_end])
+            parsed['title'] = self.clean(name[episode.end():max(title_end, episode.end())])
+            if before:
+                parsed['year'] = int(before[-1].group('year_value'))
+            elif after:
+                parsed['year'] = int(after[0].group('year_value'))
+            parsed['air_date'] = None
+            kind = episode.lastgroup
+            if kind == 'sxe':
+                parsed['season'] = int(episode.group('sxe_season'))
+                parsed['episodes'] = [int(episode.group('sxe_episode'))] + \
+                                     [int(number) for number in self.episode_rx.findall(episode.group('sxe_more'))]
+            elif kind == 'nxe':
+                parsed['season'] = int(episode.group('nxe_season'))
+                parsed['episodes'] = [int(episode.group('nxe_episode'))]
+            else:
+                # Daily shows, the season and episode are found from the air date when the show is looked up.
+                parsed['year'] = int(episode.group('date_year'))
+                parsed['season'] = None
+                parsed['episodes'] = []
+                parsed['air_date'] = '-'.join(episode.group('date_year', 'date_month', 'date_day'))
+            parsed['episode'] = parsed['episodes'][0] if parsed['episodes'] else None
+            return parsed
+        # A movie, the title runs up to the release year (the last one, Blade Runner 2049 2017).
+        if years:
+            parsed['year'] = int(years[-1].group('year_value'))
+            end = min(end, years[-1].start())
+        parsed['title'] = self.clean(name[:end]) or self.clean(name)
+        return parsed
+
+    def parse_all(self, file_names):
+        return [self.parse(file_name) for file_name in file_names]
+
 #
 # The MediaFile class, represents a media file.
 #
 class MediaFile():
-    ## Patherns to parse some info from the filename
-    tvshow_regex = '(?P<show>^\w.+)(?P<season>[sS]\d{2,3})(?P<episode>[eE]\d{2,3})(?P<episode_title>.*)$'
-    yearRx = '([\(\[ \.\-])([1-2][0-9]{3})([\.\-\)\]_,+])'
-    sizeRx = '([\s-]+?)([0-9]{3,4}[i|p])'
-    sizes = ['480p', '720p', '1080p', '480i', '720i', '1080i']
+    __slots__ = ('file', 'metadata', 'property_index', 'changes', 'analyzed', 'analyze_lock', 'saved_digest')
+    ## Parses some info from the filename
+    filename_parser = FilenameParser()
     '''
     Media Type  Stik
     Normal (Music)  1
@@ -150,8 +1628,6 @@ class MediaFile():
     media_types = { 0: 'Unknown', 1: 'Music', 2: 'Audiobook', 6: 'Music Video', 9: 'Movie',
                 10: 'TV Show', 11: 'Booklet', 14: 'Ringtone'}
 
-    ## Stuff to handle extracting the tag info out of the XML format mkv uses.
-    tag_xpath = '/Tags/Tag/Simple/Name[string() = $name]/..'
     ## Tags we are interested in.
     # Multiple instances of these tags may be present.
     multi_tags = [ 'ACTOR' ]
@@ -166,46 +1642,87 @@ class MediaFile():
     # The tags we are interested in pulling from the file.
     #
     metadata_tags = multi_tags + crew_tags + unique_tags
-    def __init__(self, file):
+    unique_tag_set = frozenset(unique_tags)
+    # How decode_simple_tags handles each tag, names starting with _ are crew jobs TMDb has that Matroska doesn't.
+    tag_kinds = dict([(tag, 'unique') for tag in unique_tags] + [(tag, 'crew') for tag in crew_tags] +
+                     [('ACTOR', 'cast')])
+    # Crew is kept grouped by job in crew_tags order, unofficial jobs go last.
+    crew_order = {tag: position for position, tag in enumerate(crew_tags)}
+    #
+    # Translate tmdb metadata info to official matroska tags.
+    #
+    tmdb_to_matroska = dict({'Writer': 'WRITEN_BY', 'Screenplay': 'SCREENPLAY_BY', 'Editor': 'EDITED_BY', 'Director': 'DIRECTOR',
+                             'Director of Photography': 'DIRECTOR_OF_PHOTOGRAPHY', 'Co-Producer': 'COPRODUCER', 
+                             'Executive Producer': 'EXECUTIVE_PRODUCER'})
+    # Use the on disk tag cache (see TagCache)
+    use_tag_cache = True
+    # Read the tags ourselves (see MatroskaFile) and only run mkvextract if that fails.
+    use_native_tags = True
+    #
+    # With lazy set only the file name is parsed, which is enough to list the file. The tags in the file are read
+    # by ensure_analyzed() when they are first needed.
+    #
+    def __init__(self, file, lazy=False):
         self.file = file
         self.metadata = {'file_path': os.path.dirname(file), 'file_name': os.path.basename(file),
-                         'tags': {'cast': [], 'genres': [], 'crew': []}}
-        self.properties = []
+                         'tags': {'genres': []}}
+        # Property by property_key(), in the order they were added.
+        self.property_index = {}
         self.changes = False
+        self.analyzed = False
+        self.analyze_lock = threading.Lock()
+        # tags_digest() of the tags in the file, None until they have been read.
+        self.saved_digest = None
 
         # get some sane defaults for the file.
         self.parse_filename(os.path.basename(file))
-        # see if we have metadata in the file
-        self.analyze_file()
+        if not lazy:
+            # see if we have metadata in the file
+            self.analyze_file()
+            self.analyzed = True
+
+    # Read the tags in the file if that hasn't been done yet, safe to call from any thread.
+    def ensure_analyzed(self):
+        if self.analyzed:
+            return
+        with self.analyze_lock:
+            if self.analyzed:
+                return
+            try:
+                self.analyze_file()
+            except Exception as Err:
+                log.error(f"Unable to read tags from {self.file}: {Err}")
+            self.analyzed = True
 
     def __str__(self):
         return "{}".format(
-            {k: val for k, val in self.__dict__.items() if not str(hex(id(val))) in str(val)}
+            {k: getattr(self, k) for k in self.__slots__ if not str(hex(id(getattr(self, k)))) in str(getattr(self, k))}
             )
+    @property
+    def properties(self):
+        return list(self.property_index.values())
+
     #
-    # Some properties we'll have multiples of but with different hash values (eg. Director, Actor etc) 
-    # Others we only want one of tags such as title, description, summary etc.
-    # this is what we do with this.
+    # Some properties we'll have multiples of (eg. Director, Actor etc), those are keyed on name, value and child.
+    # Others we only want one of tags such as title, description, summary etc, those are keyed on the name alone so
+    # adding one again updates the value, which is how the tags get edited.
     #
+    def property_key(self, property):
+        if property.name in self.unique_tag_set:
+            return property.name
+        child = property.getChild()
+        return (property.name, str(property.value), None if child is None else str(child.value))
+
     def uniqueProperty(self, property):
-        #
-        # If the hash value already present (name + value)
-        # don't add another, just return.
-        #
-        if property in self.properties:
-            return
-        if property.name in self.unique_tags:
-            for prop in self.properties:
-                if property.name == prop.name:
-                    prop.value = property.value
-                    return
-            self.properties.append(property)
-            return
-        # 
-        # If we got here it's either a unique property that hasn't been added or a non unique property that needs to be 
-        # added.
-        #
-        self.properties.append(property)
+        key = self.property_key(property)
+        existing = self.property_index.get(key)
+        if existing is None:
+            self.property_index[key] = property
+        elif property.name in self.unique_tag_set:
+            existing.value = property.value
+
+    def remove_properties(self, remove):
+        self.property_index = {key: property for key, property in self.property_index.items() if not remove(property)}
 
     def lowercase_keys(self, obj):
         if isinstance(obj, dict):
@@ -217,116 +1734,220 @@ class MediaFile():
             obj[key] = self.lowercase_keys(value)
         return obj
 
-    def parse_year(self, file_name):
-        year = None
-        yearMatch = re.search(self.yearRx, file_name)
-        if yearMatch:
-            yearInt = int(yearMatch.group(2))
-            if yearInt > 1900 and yearInt < (datetime.date.today().year + 1):
-                year = yearInt
-                file_name = file_name.replace(yearMatch.group(1) + yearMatch.group(2) + yearMatch.group(3), '')
-        return file_name, year
-
-    def parse_size(self, file_name):
-        size = None
-        sizeMatch = re.search(self.sizeRx, file_name)
-        if sizeMatch:
-            size = sizeMatch.group(2)
-            file_name = file_name.replace(sizeMatch.group(1) + sizeMatch.group(2), '')
-        return file_name, size
-
     # We parse the filename and try and set the metadata to some sane defaults before we attempt to extract the actual
     # metadata from the file.
     def parse_filename(self, file_name):
         metadata = getattr(self, 'metadata')
         tags = metadata['tags']
-        # Strip extension.
-        file, ext = os.path.splitext(file_name)
-        metadata['container'] = ext
-        # pick off the year.
-        file, year = self.parse_year(file)
-        file, size = self.parse_size(file)
+        parsed = self.filename_parser.parse(file_name)
+        metadata['container'] = parsed['container']
+        year = parsed['year']
+        metadata['filename_year'] = year
         if year:
-            tags['year'] = QDate.fromString(str(year), 'yyyy').toString(Qt.ISODate)
+            tags['year'] = f"{year}-01-01"
         else:
-            tags['year'] = str(QDate.currentDate().toString(Qt.ISODate))
-        if size:
-            tags['size'] = size
-        tvshow = re.search(self.tvshow_regex, file)
-        if tvshow and tvshow.group('season') and tvshow.group('episode'):
-            show = re.sub(r"[\._-]", " ", tvshow.group('show'))
-            episode = re.sub(r"[Ee]", '', tvshow.group('episode'))
-            season = re.sub(r"[Ss]", '', tvshow.group('season'))
-            tags['show'] = " ".join(show.split())
-            tags['title'] = re.sub(r"[\._-]", " ", tvshow.group('episode_title'))
-            tags['title'] = " ".join(tags['title'].split())
-            tags['episode'] = int(episode)
-            tags['season'] =  int(season)
+            tags['year'] = datetime.date.today().isoformat()
+        if parsed['resolution']:
+            tags['size'] = parsed['resolution']
+        if 'show' in parsed:
+            tags['show'] = parsed['show']
+            tags['title'] = parsed['title']
+            # Daily shows only have the air date until they are looked up.
+            tags['season'] = parsed['season'] or 0
+            tags['episode'] = parsed['episode'] or 0
+            if parsed['air_date']:
+                tags['air_date'] = parsed['air_date']
+            if len(parsed['episodes']) > 1:
+                tags['episodes'] = parsed['episodes']
             tags['media_type'] =  str(10)
-            self.uniqueProperty(Property('SHOW', " ".join(show.split())))
-            self.uniqueProperty(Property('SEASON', season))
-            self.uniqueProperty(Property('EPISODE', episode))
+            self.uniqueProperty(Property('SHOW', parsed['show']))
+            if parsed['season'] is not None:
+                self.uniqueProperty(Property('SEASON', str(parsed['season'])))
+            if parsed['episode'] is not None:
+                self.uniqueProperty(Property('EPISODE', str(parsed['episode'])))
             self.uniqueProperty(Property('TITLE', tags['title']))
             self.uniqueProperty(Property('MEDIA_TYPE', 10))
         else:
             # We assume a movie here bit could be any type of media. 
-            self.uniqueProperty(Property('TITLE', file))
+            self.uniqueProperty(Property('TITLE', parsed['title']))
             self.uniqueProperty(Property('MEDIA_TYPE', 9))
-            tags['title'] = file
+            tags['title'] = parsed['title']
             tags['media_type'] = str(9)
-        self.metadata['tags'].update(tags)
 
+    #
+    # Pull the global tags out of the file, the tag cache is checked first so we only run mkvextract over files that
+    # have changed since we last looked at them.
+    #
     def analyze_file(self):
+        started = time.perf_counter()
+        cache = tag_cache() if self.use_tag_cache else None
+        xml_tags = cache.get(self.file) if cache else None
+        if xml_tags is None:
+            xml_tags = self.extract_tags()
+            if xml_tags is None:
+                metrics().count('files_loaded_total', result='failed')
+                if cache:
+                    cache.remove(self.file)
+                return
+            if cache:
+                cache.put(self.file, xml_tags)
+        self.saved_digest = self.tags_digest(xml_tags)
+        self.apply_tags(xml_tags)
+        elapsed = time.perf_counter() - started
+        metrics().count('files_loaded_total', result='ok')
+        metrics().observe('file_load_seconds', elapsed)
+        log.debug('Tags read', extra=log_fields(file=self.file, seconds=elapsed, cast=len(xml_tags['cast'])))
+
+    #
+    # Return the tags we are interested in as
+    # {'cast': [{'ACTOR': .., 'CHARACTER': ..}], 'crew': [{'job': .., 'person': ..}], 'TITLE': .., ...}
+    #
+    def extract_tags(self):
+        if self.use_native_tags:
+            try:
+                with metrics().timer('tag_read_seconds', method='native'), MatroskaFile(self.file) as mkv:
+                    simple_tags = mkv.read_global_tags()
+            except (OSError, EBMLError) as Err:
+                log.warning(f"Unable to read tags from {self.file}: {Err}, trying mkvextract")
+            else:
+                if simple_tags is not None:
+                    return self.decode_simple_tags(simple_tags)
+        return self.mkvextract_tags()
+
+    #
+    # Build the extract_tags structure from (name, string, [children]) SimpleTags, as read by MatroskaFile or
+    # read_simple_tags_xml. One pass, each tag is dispatched on its name through tag_kinds.
+    #
+    def decode_simple_tags(self, simple_tags):
+        xml_tags = dict()
+        xml_tags['cast'] = []
+        xml_tags['crew'] = []
+        for name, string, children in simple_tags:
+            if string is None:
+                continue
+            kind = self.tag_kinds.get(name)
+            if kind is None and name and name.startswith('_'):
+                kind = 'crew'
+            if kind == 'cast':
+                actor = {name: string}
+                for child_name, child_string, _ in children:
+                    if child_name == 'CHARACTER':
+                        actor['CHARACTER'] = child_string
+                        break
+                xml_tags['cast'].append(actor)
+            elif kind == 'crew':
+                xml_tags['crew'].append({'job': name, 'person': string})
+            elif kind == 'unique':
+                xml_tags[name] = string
+        xml_tags['crew'].sort(key=self.crew_sort_key)
+        return xml_tags
+
+    def crew_sort_key(self, crew):
+        return self.crew_order.get(crew['job'], len(self.crew_order))
+
+    #
+    # The SimpleTags in mkvextract's XML (a file name, file object or anything else iterparse takes) as the
+    # (name, string, [children]) tuples MatroskaFile reads. Streams the document once, nested SimpleTags become
+    # children of the one they are in.
+    #
+    @staticmethod
+    def read_simple_tags_xml(source):
+        simple_tags = []
+        # [name, string, children] of the SimpleTags we are inside.
+        stack = []
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if elem.tag == 'Simple':
+                    stack.append([None, None, []])
+                continue
+            if not stack:
+                continue
+            if elem.tag == 'Name':
+                stack[-1][0] = elem.text
+            elif elem.tag == 'String':
+                stack[-1][1] = elem.text or ''
+            elif elem.tag == 'Simple':
+                simple_tag = tuple(stack.pop())
+                (stack[-1][2] if stack else simple_tags).append(simple_tag)
+                elem.clear()
+        return simple_tags
+
+    #
+    # Run mkvextract over the file, used when we can't read the tags ourselves.
+    #
+    def mkvextract_tags(self):
         _, temp_file = tempfile.mkstemp(suffix='.xml')
         try:
-            output = subprocess.run(['mkvextract', self.file, 'tags', '--global-tags', temp_file],
-                                    text = True, check = True, capture_output = True, universal_newlines = True)
+            with metrics().timer('subprocess_seconds', command='mkvextract'):
+                output = subprocess.run(['mkvextract', self.file, 'tags', '--global-tags', temp_file],
+                                        text = True, check = True, capture_output = True, universal_newlines = True)
         except subprocess.CalledProcessError as Err:
-            print ("Error encountered {Err}")
+            metrics().count('subprocess_failures_total', command='mkvextract')
+            log.error(f"Error encountered {Err}")
             os.remove(temp_file)
-            return
+            return None
         try:
-            root = ET.parse(temp_file).getroot()
+            with metrics().timer('xml_parse_seconds'):
+                simple_tags = self.read_simple_tags_xml(temp_file)
         except ET.XMLSyntaxError as Err:
-            print (f"No tag data in {self.file}")
-        else:
+            log.info(f"No tag data in {self.file}")
+            simple_tags = []
+        finally:
             os.remove(temp_file)
-            xml_tags = dict()
-            xml_tags['cast'] = []
-            xml_tags['crew'] = []
-            for tag in self.metadata_tags:
-                elem = root.xpath(self.tag_xpath, name = tag)
-                if elem:
-                    for item in elem:
-                        for sub_elem in item.getchildren():
-                            # We have an actor/character combo
-                            if sub_elem.text == 'ACTOR':
-                                parent = item.xpath('Simple/String')
-                                value  = item.xpath('String')
-                                actor = {str(tag): value[0].text}
-                                prop_actor = Property('ACTOR', value[0].text)
-                                if parent:
-                                    if parent[0] is not None:
-                                        actor['CHARACTER'] = parent[0].text
-                                        prop_actor.setChild('CHARACTER', parent[0].text)
-                                xml_tags['cast'].append(actor)
-                                self.uniqueProperty(prop_actor)
-                                break
-                                
-                            if sub_elem.tag == 'String':
-                                if str(tag) in self.crew_tags:
-                                    crew_tag = {'job': str(tag), 'person': sub_elem.text }
-                                    xml_tags['crew'].append(crew_tag)
-                                    #print (f"crew: {tag} -> {sub_elem.text} parsed")
-                                else:
-                                    self.uniqueProperty(Property(tag, sub_elem.text))
-                                    xml_tags[str(tag)] = sub_elem.text
-            if 'GENRE' in xml_tags:
-                xml_tags['genres'] = self.media_file_unpack_genres(xml_tags['GENRE'])
-            if 'TMDB' in xml_tags:
-                prefix, tmdb_id = xml_tags['TMDB'].split('/')
-                xml_tags['tmdb_id'] = tmdb_id
-            self.metadata['tags'].update(self.lowercase_keys(xml_tags))
+        return self.decode_simple_tags(simple_tags)
+
+    #
+    # Set our properties and metadata from the tags returned by extract_tags (or the tag cache)
+    #
+    def apply_tags(self, xml_tags):
+        xml_tags = dict(xml_tags)
+        # The cast and crew only live in the properties, see cast() and crew().
+        for actor in xml_tags.pop('cast', []):
+            prop_actor = Property('ACTOR', actor['ACTOR'])
+            if 'CHARACTER' in actor:
+                prop_actor.setChild('CHARACTER', actor['CHARACTER'])
+            self.uniqueProperty(prop_actor)
+        for crew_member in xml_tags.pop('crew', []):
+            self.uniqueProperty(Property(crew_member['job'], crew_member['person']))
+        for tag in self.unique_tags:
+            if tag in xml_tags:
+                self.uniqueProperty(Property(tag, xml_tags[tag]))
+        if 'GENRE' in xml_tags:
+            xml_tags['genres'] = self.media_file_unpack_genres(xml_tags['GENRE'])
+        if 'TMDB' in xml_tags:
+            prefix, tmdb_id = xml_tags['TMDB'].split('/')
+            xml_tags['tmdb_id'] = tmdb_id
+        self.metadata['tags'].update(self.lowercase_keys(xml_tags))
+
+    #
+    # The inverse of apply_tags, what extract_tags will find in the file once our properties have been written to it.
+    # Used to refresh the tag cache after a save without reading the file back.
+    #
+    def collect_tags(self):
+        xml_tags = dict()
+        xml_tags['cast'] = []
+        xml_tags['crew'] = []
+        for property in self.properties:
+            if property.name == 'ACTOR':
+                actor = {'ACTOR': str(property.value)}
+                child = property.getChild()
+                if child != None:
+                    actor['CHARACTER'] = child.value
+                xml_tags['cast'].append(actor)
+            elif self.is_crew_property(property):
+                xml_tags['crew'].append({'job': property.name, 'person': str(property.value)})
+            elif property.name in self.unique_tag_set:
+                xml_tags[property.name] = str(property.value)
+        xml_tags['crew'].sort(key=self.crew_sort_key)
+        return xml_tags
+
+    #
+    # A hash of extract_tags/collect_tags output. When the digest of collect_tags() matches the one taken when the
+    # file was read, writing would put back exactly the tags that are already there.
+    #
+    @staticmethod
+    def tags_digest(xml_tags):
+        return hashlib.sha1(json.dumps(xml_tags, sort_keys=True).encode('utf-8')).hexdigest()
 
     def media_file_pack_genres(self, tags):
         if tags:
@@ -343,59 +1964,416 @@ class MediaFile():
     def get_media_file_metadata(self):
         return getattr(self, 'metadata')
 
-    def get_media_file(self):
-        return (self.file)
+    def get_media_file(self):
+        return (self.file)
+
+    def get_media_file_tags(self):
+        metadata = getattr(self, 'metadata')
+        return (metadata['tags'])
+
+    def is_crew_property(self, property):
+        return property.name in self.crew_tags or property.name.startswith('_')
+
+    # [{'actor': .., 'character': ..}] from the ACTOR properties.
+    def cast(self):
+        cast = []
+        for property in self.property_index.values():
+            if property.name == 'ACTOR':
+                child = property.getChild()
+                cast.append({'actor': property.value, 'character': child.value if child != None else None})
+        return cast
+
+    # [{'job': .., 'person': ..}] from the crew properties.
+    def crew(self):
+        return [{'job': property.name, 'person': property.value}
+                for property in self.property_index.values() if self.is_crew_property(property)]
+
+    #
+    # Stream the global tags to out (a binary file or buffer) as mkvpropedit's XML. The properties are written in the
+    # order they were added, so the same tags always produce the same bytes.
+    #
+    def write_xml(self, out, simple_tags=None):
+        if simple_tags is None:
+            simple_tags = self.simple_tags()
+        with metrics().timer('xml_write_seconds'), ET.xmlfile(out, encoding='utf-8') as xf:
+            xf.write_declaration()
+            xf.write_doctype('<!DOCTYPE Tags SYSTEM "matroskatags.dtd">')
+            with xf.element('Tags'):
+                with xf.element('Tag'):
+                    with xf.element('Targets'):
+                        with xf.element('TargetTypeValue'):
+                            xf.write('50')
+                    for name, string, children in simple_tags:
+                        self.write_simple_tag(xf, name, string, children)
+
+    def write_simple_tag(self, xf, name, string, children):
+        with xf.element('Simple'):
+            with xf.element('Name'):
+                xf.write(name)
+            with xf.element('String'):
+                xf.write(string)
+            for child in children:
+                self.write_simple_tag(xf, *child)
+
+    def GenerateXML(self):
+        out = io.BytesIO()
+        self.write_xml(out)
+        return out.getvalue()
+
+    #
+    # Fill the tags from tmdb lookups
+    #
+    # The looked up cast replaces whatever the file had.
+    def fill_cast_tags(self, cast):
+        self.remove_properties(lambda property: property.name == 'ACTOR')
+        for cast_member in cast:
+            actor = Property('ACTOR', cast_member['name'])
+            actor.setChild('CHARACTER', cast_member['character'])
+            self.uniqueProperty(actor)
+
+    def fill_crew_tags(self, crew):
+        self.remove_properties(self.is_crew_property)
+        for crew_member in crew:
+            log.debug(f"{crew_member['job']} - {crew_member['name']}")
+            if crew_member['job'] in self.tmdb_to_matroska:
+                job = self.tmdb_to_matroska[crew_member['job']]
+                log.debug(f"{crew_member['job']} -> {job}")
+            else:
+                # We mark it as an 'unoffical tag'
+                job = '_'+crew_member['job']
+            self.uniqueProperty(Property('_'.join(job.split(' ')).upper(), crew_member['name']))
+
+    def fill_show_tags(self, show, episode_details):
+        tags = self.metadata['tags']
+        tags['show'] = show['name']
+        tags['summary'] = show['overview']
+        tags['tmdb_id'] = show['id']
+        self.uniqueProperty(Property('SUMMARY', show['overview']))
+        self.uniqueProperty(Property('SHOW', show['name']))
+        genres = []
+        for genre in show['genres']:
+            genres.append(genre['name'])
+        tags['genres'] = genres 
+        tags['genre'] = '|'.join(genres)
+        tags['tmdb'] = f"tv/{show['id']}"
+        self.uniqueProperty(Property('GENRE', '|'.join(genres)))
+        self.uniqueProperty(Property('TMDB', f"tv/{show['id']}"))
+        tags['title'] = episode_details['name']
+        tags['description'] = episode_details['overview']
+        tags['date_released'] = episode_details['air_date']
+        self.fill_cast_tags(episode_details['credits']['cast'])
+        self.fill_crew_tags(episode_details['credits']['crew'])
+        self.uniqueProperty(Property('TITLE', episode_details['name']))
+        self.uniqueProperty(Property('DESCRIPTION', episode_details['overview']))
+        self.uniqueProperty(Property('DATE_RELEASED', episode_details['air_date']))
+        self.changes = True
+
+    # A daily show's file, named by its air date rather than season and episode.
+    def is_daily(self):
+        tags = self.metadata['tags']
+        return bool(tags.get('air_date')) and not int(tags['episode'])
+
+    # The season of show (TV().details) the file's episode is in, None when a daily show had no season by then.
+    def show_season(self, show):
+        if self.is_daily():
+            return air_date_season(show, self.metadata['tags']['air_date'])
+        return int(self.metadata['tags']['season'])
+
+    # Fill the show and episode tags from the season the file belongs to.
+    # episodes is the season from season_episodes, when the caller has it already.
+    def fill_show_episode(self, show, episodes=None):
+        self.ensure_analyzed()
+        tags = self.metadata['tags']
+        season = self.show_season(show)
+        if season is None:
+            log.warning(f"No season of {show['name']} had aired by {tags['air_date']}")
+            return False
+        if episodes is None:
+            episodes = season_episodes(show['id'], season)
+        if self.is_daily():
+            # Find the episode by its air date.
+            for number, details in episodes.items():
+                if details['air_date'] == tags['air_date']:
+                    tags['season'] = season
+                    tags['episode'] = number
+                    self.uniqueProperty(Property('SEASON', str(season)))
+                    self.uniqueProperty(Property('EPISODE', str(number)))
+                    break
+            else:
+                log.warning(f"No episode of {show['name']} aired on {tags['air_date']} in season {season}")
+                return False
+        episode_details = episodes.get(int(tags['episode']))
+        if episode_details is None:
+            log.warning(f"No episode {tags['episode']} in season {tags['season']} of {show['name']}")
+            return False
+        self.fill_show_tags(show, episode_details)
+        return True
+
+    def fill_movie_tags(self, movie):
+        self.ensure_analyzed()
+        tags  = self.metadata['tags']
+        tags['tmdb_id'] = movie['id']
+        tags['tmdb'] = f"movie/{movie['id']}"
+        tags['title'] = movie['title']
+        tags['description'] = movie['overview']
+        self.uniqueProperty(Property('TMDB', f"movie/{movie['id']}"))
+        self.uniqueProperty(Property('TITLE', movie['title']))
+        self.uniqueProperty(Property('DESCRIPTION', movie['overview']))
+        genres = []
+        for genre in movie['genres']:
+            genres.append(genre['name'])
+        tags['genres'] = genres 
+        tags['genre'] = '|'.join(genres)
+        tags['date_released'] = movie['release_date']
+        self.uniqueProperty(Property('DATE_RELEASED', movie['release_date']))
+        self.uniqueProperty(Property('GENRE', '|'.join(genres)))
+        self.fill_cast_tags(movie['credits']['cast'])
+        self.fill_crew_tags(movie['credits']['crew'])
+        self.changes = True
+
+    # Our properties as the (name, string, [children]) SimpleTags MatroskaFile writes.
+    def simple_tags(self):
+        simple_tags = []
+        for property in self.properties:
+            children = []
+            child = property.getChild()
+            if child != None:
+                children.append((child.name, '' if child.value is None else str(child.value), []))
+            simple_tags.append((property.name, str(property.value), children))
+        return simple_tags
+
+    #
+    # Everything save_tags writes, taken in one go on the thread that edits the file so it can be saved on another
+    # while the edits carry on.
+    #
+    def save_snapshot(self):
+        xml_tags = self.collect_tags()
+        return {'title': self.metadata['tags']['title'], 'xml_tags': xml_tags, 'digest': self.tags_digest(xml_tags),
+                'simple_tags': self.simple_tags()}
 
-    def get_media_file_tags(self):
-        metadata = getattr(self, 'metadata')
-        return (metadata['tags'])
+    # True when the tags and title are still the ones in the snapshot.
+    def matches_snapshot(self, snapshot):
+        return (self.metadata['tags']['title'] == snapshot['title'] and
+                self.tags_digest(self.collect_tags()) == snapshot['digest'])
 
-    def GenerateXML(self):
-        root = ET.Element('Tags')
-        tag = ET.Element('Tag')
-        root.append(tag)
-        targets = ET.Element('Targets')
-        tag.append(targets)
-        targetTypeValue = ET.Element('TargetTypeValue')
-        targetTypeValue.text = '50'
-        targets.append(targetTypeValue)
-        for property in set(self.properties):
-            simple = ET.Element('Simple')
-            name = ET.Element('Name')
-            name.text = property.name
-            simple.append(name)
-            tag.append(simple)
-            string = ET.Element('String')
-            string.text = str(property.value)
-            simple.append(string)
-            child = property.getChild()
-            if child != None:
-                child_simple = ET.Element('Simple')
-                simple.append (child_simple)
-                name = ET.Element('Name')
-                name.text = child.name
-                child_simple.append(name)
-                string = ET.Element('String')
-                string.text = child.value
-                child_simple.append(string)
-        # Generate the xml file.
-        return ET.tostring(root, xml_declaration=True, pretty_print=True, 
-                             doctype='<!DOCTYPE Tags SYSTEM "matroskatags.dtd">')
+    #
+    # Write the tags and the segment title to the file. They are rewritten in place when they fit in the space
+    # (and Void padding) the old ones took up, otherwise mkvpropedit does it.
+    #
+    def save_tags(self, snapshot=None):
+        started = time.perf_counter()
+        if snapshot is None:
+            # Tags we never read would be written over.
+            self.ensure_analyzed()
+            snapshot = self.save_snapshot()
+        title = snapshot['title']
+        xml_tags = snapshot['xml_tags']
+        digest = snapshot['digest']
+        if digest == self.saved_digest:
+            metrics().count('files_saved_total', method='unchanged')
+            log.debug(f"Tags unchanged, not writing {self.file}")
+            return True
+        saved = False
+        method = 'in_place'
+        try:
+            with MatroskaFile(self.file, 'r+b') as mkv:
+                saved = mkv.write_tags_and_title(snapshot['simple_tags'], title)
+        except (OSError, EBMLError) as Err:
+            log.warning(f"Unable to write tags in place: {Err}")
+        if saved:
+            log.info(f"File saved in place: {self.file}")
+        else:
+            method = 'mkvpropedit'
+            saved = self.mkvpropedit_tags(title, snapshot['simple_tags'])
+        elapsed = time.perf_counter() - started
+        metrics().count('files_saved_total', method=method if saved else 'failed')
+        metrics().observe('file_save_seconds', elapsed, method=method)
+        log.debug('Tags written', extra=log_fields(file=self.file, method=method, saved=saved, seconds=elapsed))
+        if saved:
+            self.saved_digest = digest
+            # The file changed under the cache, record what we just wrote.
+            if self.use_tag_cache:
+                tag_cache().put(self.file, xml_tags)
+        return saved
+
+    def mkvpropedit_tags(self, title, simple_tags=None):
+        fd, tmp_file = tempfile.mkstemp(suffix='.xml')
+        with os.fdopen(fd, 'wb') as f:
+            self.write_xml(f, simple_tags)
+        try:
+            with metrics().timer('subprocess_seconds', command='mkvpropedit'):
+                result = subprocess.run(['mkvpropedit', '--gui-mode', str(self.file), '--tags',
+                                         'global:' + str(tmp_file), '--edit', 'info', '--set', f"title={title}"],
+                                        capture_output=True)
+        except OSError as err:
+            metrics().count('subprocess_failures_total', command='mkvpropedit')
+            log.error(f"File tags not written: {err}")
+            return False
+        finally:
+            os.remove(tmp_file)
+        if result.returncode != 0:
+            metrics().count('subprocess_failures_total', command='mkvpropedit')
+            log.error(f"mkvpropedit failed on {self.file}: {result.stderr or result.stdout}")
+            return False
+        log.info(f"File saved: {self.file}")
+        return True
 
     @staticmethod
     def get_media_types():
         return MediaFile.media_types
 
+#
+# Build MediaFile objects for a list of files on a pool of threads, the heavy lifting is mkvextract and disk/NAS I/O
+# so threads are enough here. Files are yielded as they finish (completion order) along with their position in the
+# original list so callers can keep the list order stable.
+#
+def load_media_files(files, jobs=None):
+    if not jobs:
+        jobs = default_load_jobs()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(MediaFile, file): position for position, file in enumerate(files)}
+        for future in as_completed(futures):
+            position = futures[future]
+            try:
+                mediafile = future.result()
+            except Exception as Err:
+                log.error(f"Unable to load {files[position]}: {Err}")
+                continue
+            yield position, mediafile
+
+# Read the tags of files created lazily, jobs at a time.
+def analyze_media_files(mediafiles, jobs=None):
+    def analyze(mediafile):
+        mediafile.ensure_analyzed()
+        return mediafile
+    with ThreadPoolExecutor(max_workers=jobs or default_load_jobs()) as pool:
+        yield from pool.map(analyze, mediafiles)
+
+def default_load_jobs():
+    return min(32, (os.cpu_count() or 1) * 2)
+
 ##
 ## This list represents the list of media files we are working on
 ## 
 class MediaFileModel(QtCore.QAbstractListModel):
+    # Rows handed to the view at a time, the rest are fetched as the view scrolls down to them.
+    batch_size = 500
+    # Emitted when rows are added past the ones the view has fetched.
+    more_available = pyqtSignal()
+    # Emitted the first time the view draws a file whose tags haven't been read.
+    analyze_requested = pyqtSignal(object)
+
     def __init__(self, *args, mediafiles=None, **kwargs):
         super(MediaFileModel, self).__init__(*args, **kwargs)
         self.mediafiles = mediafiles or []
+        # load order of each file, kept in step with mediafiles (so ascending), and the other way round for row_of.
+        self.order = list(range(len(self.mediafiles)))
+        self.order_of = {mediafile: order for order, mediafile in enumerate(self.mediafiles)}
+        # Rows the view knows about, always the first self.fetched of mediafiles.
+        self.fetched = min(len(self.mediafiles), self.batch_size)
+        self.analyze_asked = set()
+
+    # Files finish loading out of order, put each one where it belongs by its load order.
+    # They mostly arrive near the end of the list, so search from the back.
+    def insert_file(self, mediafile, order):
+        self.order_of[mediafile] = order
+        row = len(self.order)
+        while row > 0 and self.order[row - 1] > order:
+            row -= 1
+        if row < self.fetched:
+            self.beginInsertRows(QModelIndex(), row, row)
+            self.order.insert(row, order)
+            self.mediafiles.insert(row, mediafile)
+            self.fetched += 1
+            self.endInsertRows()
+        else:
+            self.order.insert(row, order)
+            self.mediafiles.insert(row, mediafile)
+            self.show_rows()
+        return row
+
+    #
+    # Add a batch of (mediafile, order). The files that belong after everything already in the list (nearly all of
+    # them while a load is running) go in as one block, only stragglers are placed one at a time.
+    #
+    def insert_files(self, files):
+        files = sorted(files, key=lambda file: file[1])
+        last = self.order[-1] if self.order else -1
+        tail = 0
+        while tail < len(files) and files[tail][1] < last:
+            tail += 1
+        for mediafile, order in files[:tail]:
+            self.insert_file(mediafile, order)
+        if tail < len(files):
+            self.mediafiles.extend(mediafile for mediafile, order in files[tail:])
+            self.order.extend(order for mediafile, order in files[tail:])
+            self.order_of.update(files[tail:])
+            self.show_rows()
+
+    # Let the view have rows up to the first batch, past that they wait for fetchMore.
+    def show_rows(self):
+        target = min(len(self.mediafiles), max(self.fetched, self.batch_size))
+        if target > self.fetched:
+            self.beginInsertRows(QModelIndex(), self.fetched, target - 1)
+            self.fetched = target
+            self.endInsertRows()
+        if self.fetched < len(self.mediafiles):
+            self.more_available.emit()
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self.fetched < len(self.mediafiles)
+
+    def fetchMore(self, parent):
+        if parent.isValid():
+            return
+        self.fetch_to(self.fetched + self.batch_size - 1)
+
+    # Make sure the view has every row up to row.
+    def fetch_to(self, row):
+        target = min(len(self.mediafiles), row + 1)
+        if target > self.fetched:
+            self.beginInsertRows(QModelIndex(), self.fetched, target - 1)
+            self.fetched = target
+            self.endInsertRows()
+
+    def fetch_all(self):
+        self.fetch_to(len(self.mediafiles) - 1)
+
+    # Found by load order, called for every file filled, saved or prefetched so it mustn't scan the list.
+    def row_of(self, mediafile):
+        order = self.order_of.get(mediafile)
+        if order is None:
+            return None
+        row = bisect.bisect_left(self.order, order)
+        if row < len(self.order) and self.mediafiles[row] is mediafile:
+            return row
+        return None
+
+    # Repaint the row of a file whose state changed.
+    def file_changed(self, mediafile):
+        row = self.row_of(mediafile)
+        if row is not None and row < self.fetched:
+            index = self.index(row, 0)
+            self.dataChanged.emit(index, index)
+
+    def remove_file(self, row):
+        self.analyze_asked.discard(id(self.mediafiles[row]))
+        self.order_of.pop(self.mediafiles[row], None)
+        if row < self.fetched:
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self.order[row]
+            del self.mediafiles[row]
+            self.fetched -= 1
+            self.endRemoveRows()
+        else:
+            del self.order[row]
+            del self.mediafiles[row]
 
     def data(self, index, role):
         mediafile = self.mediafiles[index.row()]
+        if not mediafile.analyzed and id(mediafile) not in self.analyze_asked:
+            self.analyze_asked.add(id(mediafile))
+            self.analyze_requested.emit(mediafile)
         metadata = mediafile.get_media_file_metadata()
         if role == Qt.DisplayRole:
             return metadata['file_name']
@@ -406,18 +2384,83 @@ class MediaFileModel(QtCore.QAbstractListModel):
                 return QColor(Qt.darkGreen)
 
     def rowCount(self, index):
-        return len(self.mediafiles)
+        if index.isValid():
+            return 0
+        return self.fetched
+
+#
+# What the file list view actually shows: the MediaFileModel filtered to one show, one season and/or the files with
+# unsaved changes, in load order or sorted by show, season and episode.
+#
+class MediaFileFilter(QSortFilterProxyModel):
+    def __init__(self, *args, **kwargs):
+        super(MediaFileFilter, self).__init__(*args, **kwargs)
+        self.show = None
+        self.season = None
+        self.changed_only = False
+
+    def filtering(self):
+        return self.show is not None or self.season is not None or self.changed_only
+
+    def set_filter(self, show=None, season=None, changed_only=False):
+        self.show = show
+        self.season = season
+        self.changed_only = changed_only
+        if self.filtering():
+            # Filter the whole list, not just the rows the view has scrolled to.
+            self.sourceModel().fetch_all()
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        mediafile = self.sourceModel().mediafiles[source_row]
+        tags = mediafile.metadata['tags']
+        if self.changed_only and not mediafile.changes:
+            return False
+        if self.show is not None and tags.get('show') != self.show:
+            return False
+        if self.season is not None and str(tags.get('season')) != str(self.season):
+            return False
+        return True
+
+    @staticmethod
+    def sort_key(mediafile):
+        tags = mediafile.metadata['tags']
+        number = lambda value: int(value) if str(value).isdigit() else 0
+        return (tags.get('show') or tags.get('title') or '', number(tags.get('season')), number(tags.get('episode')),
+                mediafile.metadata['file_name'])
+
+    def lessThan(self, left, right):
+        mediafiles = self.sourceModel().mediafiles
+        return self.sort_key(mediafiles[left.row()]) < self.sort_key(mediafiles[right.row()])
+
+    def sort_by_show(self, enabled):
+        if enabled:
+            self.sourceModel().fetch_all()
+            self.sort(0)
+        else:
+            # Back to load order.
+            self.sort(-1)
 
 #
 # When we have multiple results from a tmdb search present a dialog to pick one.
 #
 ### Search Results dialog.
 class SearchResults(QDialog):
-    def __init__(self, results, tmdb):
+    # Posters fetched as soon as the dialog opens.
+    prefetch = 8
+    poster_size = 'w185'
+
+    def __init__(self, results, tmdb, tmdb_config=None, threadpool=None):
         super(SearchResults, self).__init__()
-        self.w = loadUi(sys.path[0] + '/ui/tmdb_lookup_results.ui', self)
+        setup_ui(self, 'tmdb_lookup_results')
+        self.w = self
         self.tmdb = tmdb
-        self.tmdb_config = Configuration().info()
+        # MainWindow loads the configuration off the GUI thread. Until it has one (first run, offline) the results
+        # are listed without posters.
+        self.tmdb_config = tmdb_config
+        self.threadpool = threadpool or QThreadPool.globalInstance()
+        self.poster_url = None
+        self.fetching = set()
         self.search_results = results
         self.ReleaseDate.clear() 
         for res in results:
@@ -430,10 +2473,43 @@ class SearchResults(QDialog):
         self.ResultsList.itemClicked.connect(self.ResultsListClicked)
         self.ResultsList.currentRowChanged.connect(self.ResultsListCurrentRowChanged)
         self.ResultsList.itemDoubleClicked.connect(self.ResultListPicked)
+        self.prefetch_posters()
         # 9 Times out of ten the first result is the one we want, so lets select that automatically
         self.ResultsList.setCurrentRow(0)
         self.w.show()
 
+    def result_poster_url(self, result):
+        if self.tmdb_config and 'poster_path' in result and result['poster_path'] is not None:
+            return self.tmdb_config['images']['secure_base_url'] + self.poster_size + result['poster_path']
+        return None
+
+    def prefetch_posters(self):
+        urls = []
+        for row in range(min(self.prefetch, self.ResultsList.count())):
+            url = self.result_poster_url(self.ResultsList.item(row).data(Qt.UserRole))
+            if url and not poster_cache().get(url):
+                urls.append(url)
+        for url in urls:
+            self.fetch_poster(url)
+
+    # Only for urls the poster cache doesn't have, the callers have already asked it.
+    def fetch_poster(self, url):
+        if url in self.fetching:
+            return
+        self.fetching.add(url)
+        worker = Worker(self.fetch_poster_worker, url, progress_callback=None)
+        worker.signals.result.connect(self.poster_fetched)
+        self.threadpool.start(worker)
+
+    def fetch_poster_worker(self, url, progress_callback):
+        return url, poster_cache().download(url)
+
+    def poster_fetched(self, fetched):
+        url, name = fetched
+        self.fetching.discard(url)
+        if name and url == self.poster_url:
+            self.Poster.load(QUrl.fromLocalFile(name))
+
     def getSelectedResult(self):
         selected = self.ResultsList.item(self.ResultsList.currentRow())
         return selected
@@ -454,10 +2530,13 @@ class SearchResults(QDialog):
             self.Name.setText(result['title'])
         else:
             self.Name.setText(result['name'])
-        if 'poster_path' in result:
-            if result['poster_path'] is not None:
-                poster_url = self.tmdb_config['images']['secure_base_url'] + 'w185' + result['poster_path']
-                self.Poster.load(QUrl(poster_url))
+        self.poster_url = self.result_poster_url(result)
+        if self.poster_url:
+            name = poster_cache().get(self.poster_url)
+            if name:
+                self.Poster.load(QUrl.fromLocalFile(name))
+            else:
+                self.fetch_poster(self.poster_url)
 
     def ResultsListClicked(self, item):
         result = item.data(Qt.UserRole)
@@ -474,33 +2553,56 @@ class SearchResults(QDialog):
 # 
 # Main application
 #
-class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
-    #
-    # Translate tmdb metadata info to official matroska tags.
-    #
-    tmdb_to_matroska = dict({'Writer': 'WRITEN_BY', 'Screenplay': 'SCREENPLAY_BY', 'Editor': 'EDITED_BY', 'Director': 'DIRECTOR',
-                             'Director of Photography': 'DIRECTOR_OF_PHOTOGRAPHY', 'Co-Producer': 'COPRODUCER', 
-                             'Executive Producer': 'EXECUTIVE_PRODUCER'})
-    def __init__(self):
+class MainWindow(QtWidgets.QMainWindow):
+    def __init__(self, load_jobs=None):
         QtWidgets.QMainWindow.__init__(self)
-        Ui_MainWindow.__init__(self)
         self.current_path = os.getcwd() 
-        self.setupUi(self)
+        setup_ui(self, 'main_window')
+        self.load_jobs = load_jobs or default_load_jobs()
+        self.load_sequence = 0
         self.model = MediaFileModel()
-        self.media_file_view.setModel(self.model)
+        self.proxy = MediaFileFilter()
+        self.proxy.setSourceModel(self.model)
+        self.media_file_view.setModel(self.proxy)
+        # Files from the load workers are added to the model in batches.
+        self.pending_files = []
+        self.pending_timer = QTimer(self)
+        self.pending_timer.setSingleShot(True)
+        self.pending_timer.setInterval(100)
+        self.pending_timer.timeout.connect(self.add_pending_files)
         self.setup_media_types()
         self.setup_cast_model()
         self.setup_crew_model()
         self.threadpool = QThreadPool()
+        # Reads the tags of files opened lazily as the view shows them, prefetch_tags gets the rest.
+        self.analyze_pool = QThreadPool()
+        self.analyze_pool.setMaxThreadCount(self.load_jobs)
+        self.tmdb = None
+        self.tmdb_config = None
+        self.lookup_file = None
+        self.lookup_generation = 0
+        self.resultsDialog = None
+        self.matcher = AutoMatcher()
+        self.review_queue = collections.deque()
+        self.save_jobs = 4
+        self.save_queue = collections.deque()
+        self.saving = set()
+        self.save_again = set()
+        self.closing = set()
+        self.saves_running = 0
+        self.save_total = 0
+        self.save_done = 0
+        self.save_failures = []
 #        self.setup_tmdb()
 
+        self.genre_list_source = None
+        self.genre_rows = {}
+        self.load_reference_data()
         worker = Worker(self.setup_tmdb, progress_callback=None)
+        worker.signals.result.connect(self.reference_data_refreshed)
         worker.signals.finished.connect(self.tmdb_complete)
         self.threadpool.start(worker)
 
-        self.tv_genres = self.get_tv_genres()
-        self.movie_genres = self.get_movie_genres()
-
         self.media_file_metadata_lookup_btn.setEnabled(False)
         self.media_file_tvshow_frame.setEnabled(False)
         self.media_file_media_types.setEnabled(False)
@@ -510,8 +2612,17 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self.media_file_media_types.activated.connect(self.media_file_media_types_activated)
         self.actionOpenFiles.triggered.connect(self.files_dialog)
         self.actionSaveFile.triggered.connect(self.save_file)
+        self.actionSaveAllFiles.triggered.connect(self.save_all_files)
+        self.actionAutoMatch.triggered.connect(self.auto_match_files)
         self.actionCloseFile.triggered.connect(self.close_file)
         self.actionQuit.triggered.connect(self.close)
+        self.actionSortByShow.toggled.connect(self.proxy.sort_by_show)
+        self.actionShowChangedOnly.toggled.connect(self.filter_changed_only)
+        self.actionFilterShow.triggered.connect(self.filter_show)
+        self.actionFilterSeason.triggered.connect(self.filter_season)
+        self.actionClearFilter.triggered.connect(self.clear_filter)
+        self.model.more_available.connect(self.fetch_visible_rows)
+        self.model.analyze_requested.connect(self.analyze_visible_file)
 
         self.media_file_metadata_lookup_btn.clicked.connect(self.media_file_metadata_lookup)
 
@@ -529,52 +2640,36 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self.media_file_crew_view.horizontalHeader().setSectionResizeMode(1)
         self.media_file_crew_view.horizontalHeader().setDefaultAlignment(QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter)
 
+    # Reference data from the last session, the setup_tmdb worker refreshes anything that has expired.
+    def load_reference_data(self):
+        store = reference_store()
+        self.tmdb_config = store.get('configuration')[0]
+        self.tv_genres = store.get('tv_genres')[0] or []
+        self.movie_genres = store.get('movie_genres')[0] or []
+        log.info(f"Loaded {len(self.tv_genres)} tv and {len(self.movie_genres)} movie genres")
+
     def setup_tmdb(self, progress_callback):
-        self.tmdb = TMDb()
-        self.tmdb.language = "en"
-        config = Configuration()
-        self.tmdb_config = config.info()
+        self.tmdb = setup_tmdb()
+        return reference_store().refresh(tmdb_reference_fetchers())
+
+    def reference_data_refreshed(self, refreshed):
+        if 'configuration' in refreshed:
+            self.tmdb_config = refreshed['configuration']
+        if 'tv_genres' in refreshed:
+            self.tv_genres = refreshed['tv_genres']
+        if 'movie_genres' in refreshed:
+            self.movie_genres = refreshed['movie_genres']
+        if refreshed:
+            log.info(f"Refreshed {', '.join(sorted(refreshed))}")
+        if 'tv_genres' in refreshed or 'movie_genres' in refreshed:
+            file = self.current_file()
+            if file:
+                self.media_file_update_genres(file.metadata, rebuild=True)
 
     def tmdb_complete(self):
-        print ("tmdb initialized, enable lookups")
+        log.info("tmdb initialized, enable lookups")
         self.media_file_metadata_lookup_btn.setEnabled(True)
 
-    def get_tv_genres(self):
-        genres = self.load_genres('tv_genres')
-        if genres:
-            print ("Loaded cached tv genres")
-            return genres
-        else:
-            if self.tmdb:
-                tmdb = Genre()
-                genres = tmdb.tv_list()
-                self.save_genres('tv_genres', genres)
-                return genres
-        return None
-
-    def get_movie_genres(self):
-        genres = self.load_genres('movie_genres')
-        if genres:
-            print ("Loaded cached movies generes")
-            return genres
-        else:
-            if self.tmdb:            
-                tmdb = Genre()
-                genres = tmdb.movie_list()
-                self.save_genres('movie_genres', genres)
-                return genres 
-
-    def load_genres(self, genre):
-        try:
-            with open(f"{sys.path[0]}/{genre}.pkl", 'rb') as f:
-                return pickle.load(f)
-        except:
-                return None
-
-    def save_genres(self, genre, genres):
-        with open(f"{sys.path[0]}/{genre}.pkl", 'wb') as f:
-            pickle.dump(genres, f)
-
     def setup_media_types(self):
         media_types = MediaFile.get_media_types()
         for key, value in media_types.items():
@@ -626,7 +2721,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
     def update_metadata_cast_display(self, cast):
         self.cast_model.removeRows(0, self.cast_model.rowCount())
         for cast_member in cast:
-            row = (QStandardItem(cast_member['actor']), QStandardItem(cast_member['character']))
+            row = (QStandardItem(str(cast_member['actor'])), QStandardItem(cast_member['character'] or ''))
             self.cast_model.appendRow(row)
             self.cast_model.layoutChanged.emit()
 
@@ -635,12 +2730,13 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         for crew_member in crew:
             # Matroska wants tags stored with underscores instead of spaces and in upper case, this will reverse it for 
             # display purposes.
-            job = ' '.join(crew_member['job'].split('_')).title()
-            row = (QStandardItem(crew_member['person']), QStandardItem(job))
+            job = ' '.join(crew_member['job'].split('_')).strip().title()
+            row = (QStandardItem(str(crew_member['person'])), QStandardItem(job))
             self.crew_model.appendRow(row)
             self.crew_model.layoutChanged.emit()
 
-    def update_metadata_display(self, metadata):
+    def update_metadata_display(self, file):
+        metadata = file.metadata
         tags = metadata['tags']
         self.media_file_media_types.setCurrentIndex(self.media_file_media_types.findData(int(tags['media_type'])))
         self.media_file_file_name.setText(metadata['file_name'])
@@ -673,182 +2769,318 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             self.media_file_genre_tag.setText('')
         if 'title' in tags:
             self.media_file_title.setText(tags['title'])
-        self.update_metadata_cast_display(metadata['tags']['cast'])
-        self.update_metadata_crew_display(metadata['tags']['crew'])
+        self.update_metadata_cast_display(file.cast())
+        self.update_metadata_crew_display(file.crew())
 
-    def media_file_update_genres(self, metadata):
+    #
+    # The genre list is only rebuilt when it switches between the tv and movie genres (or they are refreshed),
+    # genre_rows maps each name to its row so selecting a file's genres is an exact lookup per genre.
+    #
+    def fill_genre_list(self, genres):
         self.media_file_genre_list.clear()
-        if metadata['tags']['media_type'] == 10:
-            genres = self.tv_genres
-        else:
-            genres = self.movie_genres
+        self.genre_rows = {}
         for genre in genres:
-            item = QListWidgetItem(genre['name'])
-            self.media_file_genre_list.addItem(item)
+            self.genre_rows[genre['name']] = self.media_file_genre_list.count()
+            self.media_file_genre_list.addItem(QListWidgetItem(genre['name']))
+
+    def media_file_update_genres(self, metadata, rebuild=False):
+        genres = self.tv_genres if int(metadata['tags']['media_type']) == 10 else self.movie_genres
+        if rebuild or genres is not self.genre_list_source:
+            self.fill_genre_list(genres)
+            self.genre_list_source = genres
+        self.media_file_genre_list.clearSelection()
         for genre in metadata['tags']['genres']:
-            matches = self.media_file_genre_list.findItems(genre, Qt.MatchContains)
-            for match in matches:
-                match.setSelected(True)
+            row = self.genre_rows.get(genre)
+            if row is not None:
+                self.media_file_genre_list.item(row).setSelected(True)
 
     #
     # tag handling
     #
-    def media_file_fill_cast_tags(self, file, cast):
-        cast_tags = []
-        for cast_member in cast:
-            actor = Property('ACTOR', cast_member['name'])
-            actor.setChild('CHARACTER', cast_member['character'])
-            file.uniqueProperty(actor)
-            cast_tags.append({'actor': cast_member['name'], 'character': cast_member['character']})
-        return cast_tags
+    # The other open episodes that may be of file's show: same show name and same year in the file name (The.Office.2001
+    # and The.Office.2005 are different shows). Only the file names are looked at, this runs on the GUI thread.
+    #
+    def show_candidates(self, file):
+        show_name = file.metadata['tags']['show'].lower()
+        year = file.metadata.get('filename_year')
+        return [mediafile for mediafile in self.model.mediafiles
+                if mediafile is not file and int(mediafile.metadata['tags']['media_type']) == 10 and
+                mediafile.metadata['tags'].get('show', '').lower() == show_name and
+                mediafile.metadata.get('filename_year') == year]
 
-    def media_file_fill_crew_tags(self, file, crew):
-        crew_tags = []
-        for crew_member in crew:
-            print (f"{crew_member['job']} - {crew_member['name']}")
-            if crew_member['job'] in self.tmdb_to_matroska:
-                job = self.tmdb_to_matroska[crew_member['job']]
-                print (f"{crew_member['job']} -> {job}")
-            else:
-                # We mark it as an 'unoffical tag'
-                job = '_'+crew_member['job']
-            crew_tags.append({'job': job, 'person': crew_member['name']})         
-            file.uniqueProperty(Property('_'.join(job.split(' ')).upper(), crew_member['name']))
-        return crew_tags
-
-    def media_file_fill_show_tags(self, show):
-        index = self.media_file_view.selectionModel().currentIndex()
-        file  = self.model.mediafiles[index.row()]
-        tags = file.metadata['tags']
-        tags['show'] = show['name']
-        tags['summary'] = show['overview']
-        tags['tmdb_id'] = show['id']
-        file.uniqueProperty(Property('SUMMARY', show['overview']))
-        file.uniqueProperty(Property('SHOW', show['name']))
-        genres = []
-        for genre in show['genres']:
-            genres.append(genre['name'])
-        tags['genres'] = genres 
-        tags['genre'] = '|'.join(genres)
-        tags['tmdb'] = f"tv/{show['id']}"
-        file.uniqueProperty(Property('GENRE', '|'.join(genres)))
-        file.uniqueProperty(Property('TMDB', f"tv/{show['id']}"))
-        episode = Episode()
-        episode_details = episode.details(show['id'], tags['season'], tags['episode'], append_to_response="credits")
-        tags['title'] = episode_details['name']
-        tags['description'] = episode_details['overview']
-        tags['date_released'] = episode_details['air_date']
-        tags['cast'] = self.media_file_fill_cast_tags(file, episode_details['credits']['cast'])
-        tags['crew'] = self.media_file_fill_crew_tags(file, episode_details['credits']['crew'])
-        file.uniqueProperty(Property('TITLE', episode_details['name']))
-        file.uniqueProperty(Property('DESCRIPTION', episode_details['overview']))
-        file.uniqueProperty(Property('DATE_RELEASED', episode_details['air_date']))
-        file.changes = True
-        self.update_metadata_display(file.metadata)
-        print ("Allow more lookups.")
+    #
+    # Runs on the worker thread. file and those of the candidates to fill with show: the ones that haven't been looked
+    # up, which takes reading their tags. A year in the file name has to agree with when the show first aired, daily
+    # shows are named by air date so that year says nothing.
+    #
+    def show_files(self, file, show, candidates):
+        year = file.metadata.get('filename_year')
+        first_aired = show.get('first_air_date') or ''
+        files = [file]
+        if year and first_aired and not file.metadata['tags'].get('air_date') and \
+                not first_aired.startswith(str(year)):
+            return files
+        for mediafile in analyze_media_files(candidates, self.load_jobs):
+            if 'tmdb_id' not in mediafile.metadata['tags']:
+                files.append(mediafile)
+        return files
+
+    #
+    # The show applies to every open episode of it that hasn't been looked up yet (found by fetch_show), they are all
+    # filled from one request per season.
+    #
+    def media_file_fill_show_tags(self, fetched):
+        show, files, seasons = fetched
+        file = self.lookup_file
+        if len(files) > 1:
+            button = QMessageBox.question(self, "Other Episodes",
+                                          f"Also fill the {len(files) - 1} other open episodes of {show['name']}?",
+                                          QMessageBox.Yes | QMessageBox.No, defaultButton=QMessageBox.Yes)
+            if button != QMessageBox.Yes:
+                files = [file]
+        for mediafile in files:
+            if mediafile.fill_show_episode(show, seasons.get(mediafile.show_season(show))):
+                self.model.file_changed(mediafile)
+        self.update_metadata_display(file)
+        log.debug("Allow more lookups.")
         self.media_file_metadata_lookup_btn.setEnabled(True)
+        self.review_next()
 
     def media_file_fill_movie_tags(self, movie):
-        index = self.media_file_view.selectionModel().currentIndex()
-        file  = self.model.mediafiles[index.row()]
-        tags  = file.metadata['tags']
-        tags['tmdb_id'] = movie['id']
-        tags['tmdb'] = f"movie/{movie['id']}"
-        tags['title'] = movie['title']
-        tags['description'] = movie['overview']
-        file.uniqueProperty(Property('TMDB', f"movie/{movie['id']}"))
-        file.uniqueProperty(Property('TITLE', movie['title']))
-        file.uniqueProperty(Property('DESCRIPTION', movie['overview']))
-        genres = []
-        for genre in movie['genres']:
-            genres.append(genre['name'])
-        tags['genres'] = genres 
-        tags['genre'] = '|'.join(genres)
-        tags['date_released'] = movie['release_date']
-        file.uniqueProperty(Property('DATE_RELEASED', movie['release_date']))
-        file.uniqueProperty(Property('GENRE', '|'.join(genres)))
-        tags['cast'] = self.media_file_fill_cast_tags(file, movie['credits']['cast'])
-        tags['crew'] = self.media_file_fill_crew_tags(file, movie['credits']['crew'])
-        file.changes = True
-        self.update_metadata_display(file.metadata)
-        print ("Allow more lookups.")
+        file = self.lookup_file
+        file.fill_movie_tags(movie)
+        self.model.file_changed(file)
+        self.update_metadata_display(file)
+        log.debug("Allow more lookups.")
+        self.media_file_metadata_lookup_btn.setEnabled(True)
+        self.review_next()
+
+    #
+    # Lookups run on the thread pool and their results come back through the worker's result signal, the GUI thread
+    # never waits on TMDb. A lookup is for the file selected when it started, changing the selection makes it stale
+    # and its result is dropped when it arrives.
+    #
+    def start_lookup(self, on_result, fn, *args):
+        generation = self.lookup_generation
+        worker = Worker(fn, *args, progress_callback=None)
+        worker.signals.result.connect(lambda result: self.lookup_result(generation, on_result, result))
+        worker.signals.error.connect(lambda error: self.lookup_error(generation, error))
+        self.threadpool.start(worker)
+
+    def lookup_result(self, generation, on_result, result):
+        if generation != self.lookup_generation:
+            log.debug("Dropping stale lookup result")
+            return
+        on_result(result)
+
+    def lookup_error(self, generation, error):
+        if generation != self.lookup_generation:
+            return
+        exctype, value, trace = error
+        QMessageBox.critical(self, "Error", f"Lookup failed: {value}", QMessageBox.Ok)
         self.media_file_metadata_lookup_btn.setEnabled(True)
+        self.review_next()
+
+    # The results dialog for the lookup goes too, picking from it would fill a file nobody is looking at.
+    def cancel_lookup(self):
+        self.lookup_generation += 1
+        self.lookup_file = None
+        if self.resultsDialog is not None:
+            self.resultsDialog.close()
+            self.resultsDialog = None
+        self.media_file_metadata_lookup_btn.setEnabled(self.tmdb is not None)
 
     #
-    # Metadata searchs/functions
+    # Metadata searchs/functions, the search_* and fetch_* functions run on the worker thread.
     #
+    def search_tvshow(self, term, progress_callback):
+        tv = TV()
+        return tv.search(term)
+
+    def fetch_show(self, tmdb_id, file, candidates, progress_callback):
+        tv = TV()
+        show = tv.details(tmdb_id)
+        files = self.show_files(file, show, candidates)
+        # Get the seasons we need now so filling the files doesn't go to the network.
+        seasons = {}
+        for season in {mediafile.show_season(show) for mediafile in files} - {None}:
+            seasons[season] = season_episodes(show['id'], season)
+        return show, files, seasons
+
+    def search_movie(self, term, progress_callback):
+        search = Search()
+        try:
+            return search.movies(term, adult = True)
+        except TMDbException:
+            return None
+
+    def fetch_movie(self, tmdb_id, progress_callback):
+        movie = Movie()
+        return movie.details(tmdb_id, append_to_response='credits')
+
     def media_file_lookup_tvshow(self):
-        print ("Disable lookups")
+        log.debug("Disable lookups")
         self.media_file_metadata_lookup_btn.setEnabled(False)
         term = self.media_file_tvshow.text()
         if term:
-            tv = TV()
-            results = tv.search(term)
-            if results['total_results'] == 1:
-                tmdb_id = results[0]['id']
-                show = tv.details(tmdb_id)
-                self.media_file_fill_show_tags(show)
-            else:
-                self.resultsDialog = SearchResults(results, self.tmdb)
-                self.resultsDialog.buttonBox.accepted.connect(self.media_file_selected_show)
-                self.resultsDialog.buttonBox.rejected.connect(self.search_dialog_cancel)
+            self.start_lookup(self.media_file_tvshow_results, self.search_tvshow, term)
+        else:
+            self.media_file_metadata_lookup_btn.setEnabled(True)
+
+    def media_file_tvshow_results(self, results):
+        if results['total_results'] == 1:
+            self.media_file_fetch_show(results[0]['id'])
+        else:
+            self.resultsDialog = SearchResults(results, self.tmdb, self.tmdb_config, self.threadpool)
+            self.resultsDialog.buttonBox.accepted.connect(self.media_file_selected_show)
+            self.resultsDialog.buttonBox.rejected.connect(self.search_dialog_cancel)
 
     def media_file_selected_show(self):
+        if self.lookup_file is None or self.resultsDialog is None:
+            return
         item = self.resultsDialog.getSelectedResult()
-        tmdb_id = item.data(Qt.UserRole)['id']
-        tv = TV()
-        show = tv.details(tmdb_id)
-        self.media_file_fill_show_tags(show)
+        self.media_file_fetch_show(item.data(Qt.UserRole)['id'])
+
+    def media_file_fetch_show(self, tmdb_id):
+        file = self.lookup_file
+        self.start_lookup(self.media_file_fill_show_tags, self.fetch_show, tmdb_id, file, self.show_candidates(file))
 
     def media_file_lookup_movie(self):
-        print ("Disable lookups?")
+        log.debug("Disable lookups?")
         self.media_file_metadata_lookup_btn.setEnabled(False)
         term = self.media_file_title.text()
         if term:
-            search = Search()
-            try:
-                results = search.movies(term, adult = True)
-            except TMDbException:
-                print ("Movie not found")
-                return
-            if results['total_results'] == 1:
-                movie = Movie()
-                details = movie.details(results[0]['id'], append_to_response='credits')
-                self.media_file_fill_movie_tags(details)
-            else:
-                self.resultsDialog = SearchResults(results, self.tmdb)
-                self.resultsDialog.buttonBox.accepted.connect(self.media_file_selected_movie)
-                self.resultsDialog.buttonBox.rejected.connect(self.search_dialog_cancel)
+            self.start_lookup(self.media_file_movie_results, self.search_movie, term)
+        else:
+            self.media_file_metadata_lookup_btn.setEnabled(True)
+
+    def media_file_movie_results(self, results):
+        if results is None:
+            log.info("Movie not found")
+            self.media_file_metadata_lookup_btn.setEnabled(True)
+            return
+        if results['total_results'] == 1:
+            self.start_lookup(self.media_file_fill_movie_tags, self.fetch_movie, results[0]['id'])
+        else:
+            self.resultsDialog = SearchResults(results, self.tmdb, self.tmdb_config, self.threadpool)
+            self.resultsDialog.buttonBox.accepted.connect(self.media_file_selected_movie)
+            self.resultsDialog.buttonBox.rejected.connect(self.search_dialog_cancel)
 
     def media_file_selected_movie(self):
+        if self.lookup_file is None or self.resultsDialog is None:
+            return
         item = self.resultsDialog.getSelectedResult()
-        tmdb_id = item.data(Qt.UserRole)['id']
-        movie = Movie()
-        details = movie.details(tmdb_id, append_to_response = 'credits')
-        self.media_file_fill_movie_tags(details)
+        self.start_lookup(self.media_file_fill_movie_tags, self.fetch_movie, item.data(Qt.UserRole)['id'])
 
     def search_dialog_cancel(self):
-        print ("Dialog cancelled")
+        log.debug("Dialog cancelled")
         self.media_file_metadata_lookup_btn.setEnabled(True)
+        self.review_next()
+
+    #
+    # Auto match every open file that hasn't been looked up yet. Confident matches are filled as they come in, the
+    # ambiguous ones are queued and their search results shown one at a time once the run is over.
+    #
+    def auto_match_files(self):
+        files = [mediafile for mediafile in self.model.mediafiles if 'tmdb_id' not in mediafile.metadata['tags']]
+        if not files:
+            return
+        self.actionAutoMatch.setEnabled(False)
+        self.auto_match_count = 0
+        self.auto_match_total = len(files)
+        worker = Worker(self.auto_match, files, progress_callback=self.auto_match_progress)
+        worker.signals.progress.connect(self.auto_match_progress)
+        worker.signals.finished.connect(self.auto_match_complete)
+        self.threadpool.start(worker)
+
+    # Runs on the worker thread. Files opened lazily are only known to be untagged once their tags are read.
+    def auto_match(self, files, progress_callback):
+        files = [mediafile for mediafile in analyze_media_files(files, self.load_jobs)
+                 if 'tmdb_id' not in mediafile.metadata['tags']]
+        for match in self.matcher.match_all(files):
+            progress_callback.emit((match, len(files)))
+
+    def auto_match_progress(self, progress):
+        match, self.auto_match_total = progress
+        self.auto_match_count += 1
+        if match.status == 'matched':
+            if match.fill():
+                self.model.file_changed(match.mediafile)
+        elif match.status == 'ambiguous':
+            self.review_queue.append(match)
+        elif match.status in ('error', 'missing'):
+            log.warning(f"Lookup failed for {match.mediafile.file}: {match.error}")
+        self.statusbar.showMessage(f"Matched {self.auto_match_count} of {self.auto_match_total} files, "
+                                   f"{len(self.review_queue)} to review")
+
+    def auto_match_complete(self):
+        self.actionAutoMatch.setEnabled(True)
+        self.review_next()
+
+    # Show the search results for the next queued file, the lookup dialogs call back here when they are done.
+    def review_next(self):
+        while self.review_queue:
+            match = self.review_queue.popleft()
+            mediafile = match.mediafile
+            # Filling another episode may have taken care of it.
+            if 'tmdb_id' in mediafile.metadata['tags'] or self.model.row_of(mediafile) is None:
+                continue
+            index = self.view_index(mediafile)
+            if index.isValid():
+                self.media_file_view.setCurrentIndex(index)
+            self.cancel_lookup()
+            self.lookup_file = mediafile
+            self.media_file_metadata_lookup_btn.setEnabled(False)
+            results = [result for score, result in match.candidates]
+            self.resultsDialog = SearchResults(results, self.tmdb, self.tmdb_config, self.threadpool)
+            if int(mediafile.metadata['tags']['media_type']) == 10:
+                self.resultsDialog.buttonBox.accepted.connect(self.media_file_selected_show)
+            else:
+                self.resultsDialog.buttonBox.accepted.connect(self.media_file_selected_movie)
+            self.resultsDialog.buttonBox.rejected.connect(self.search_dialog_cancel)
+            return
 
 #
 # Signals
 #
+    # A file whose tags haven't been read yet is read on the analyze pool, its details are shown when that finishes
+    # (if it is still the one selected).
     def media_file_view_row_changed(self, selected, deslected):
         indexes = selected.indexes()
         if indexes:
-            index = indexes[0]
-            file = self.model.mediafiles[index.row()]
+            file = self.file_at(indexes[0])
+            if file is not self.lookup_file:
+                self.cancel_lookup()
+            if file.analyzed:
+                self.show_file_details(file)
+                return
+            self.clear_metadata_display()
             self.media_file_file_path.setText(file.metadata['file_path'])
-            self.media_file_media_types.setEnabled(True)
-            self.update_metadata_display(file.get_media_file_metadata())
-            if self.tmdb:
-                self.button_frame.setEnabled(True)
+            self.media_file_media_types.setEnabled(False)
+            self.button_frame.setEnabled(False)
+            self.statusbar.showMessage(f"Reading tags from {os.path.basename(file.file)}")
+            worker = Worker(self.analyze_worker, file, progress_callback=None)
+            worker.signals.result.connect(self.selected_file_analyzed)
+            self.analyze_pool.start(worker)
+
+    def selected_file_analyzed(self, mediafile):
+        self.model.file_changed(mediafile)
+        if mediafile is self.current_file():
+            self.statusbar.clearMessage()
+            self.show_file_details(mediafile)
+
+    def show_file_details(self, file):
+        self.media_file_file_path.setText(file.metadata['file_path'])
+        self.media_file_media_types.setEnabled(True)
+        self.update_metadata_display(file)
+        if self.tmdb:
+            self.button_frame.setEnabled(True)
 
     def media_file_media_types_activated(self, index):
         media_type = int(self.media_file_media_types.itemData(index))
-        index = media_file_view.selectionModel().curentIndex()
-        file  = self.model.mediafiles[index.row()]
+        file = self.current_file()
+        if file is None:
+            return
         if media_type == 10:
             self.media_file_tvshow_frame.setEnabled(True)
         else:
@@ -857,10 +3089,8 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         file.metadata['changed'] = True
 
     def media_file_genre_list_item_clicked(self, item):
-        indexes = self.media_file_view.selectionModel().selectedIndexes()
-        if indexes:
-            index = indexes[0]
-            file  = self.model.mediafiles[index.row()]
+        file = self.current_file()
+        if file:
             genres = file.metadata['tags']['genres']
             if item.isSelected():
                 genres.append(item.text())
@@ -874,97 +3104,274 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
     def media_file_metadata_lookup (self):
         media_type_name = self.media_file_media_types.currentText()
         media_type = self.media_file_media_types.itemData(self.media_file_media_types.currentIndex())
-        print ("Disable additional lookups")
+        self.cancel_lookup()
+        log.debug("Disable additional lookups")
         self.media_file_metadata_lookup_btn.setEnabled(False)
+        self.lookup_file = self.file_at(self.media_file_view.selectionModel().currentIndex())
         if media_type == 10:
             self.media_file_lookup_tvshow()
         elif media_type == 9:
             self.media_file_lookup_movie()
         else:
             QMessageBox.critical(self, "Error", f"No metadata lookup for {media_type_name} implemented.", QMessageBox.Ok)
+            self.media_file_metadata_lookup_btn.setEnabled(True)
 
     #
     # Save the tags.
     # 
     def save_file(self, file):
-        indexes = self.media_file_view.selectedIndexes()
-        for index in indexes:
-            mediafile = self.model.mediafiles[index.row()]
-            print (f"Save file {mediafile.file}")
-            print (mediafile.metadata['tags']['title'])
-            xml = mediafile.GenerateXML()
-            _, tmp_file = tempfile.mkstemp()
-            with open(tmp_file, 'w') as f:
-                f.write(str(xml))
-            try:
-                result = subprocess.run(['mkvpropedit', '--gui-mode', str(mediafile.file), '--tags', 
-                                        'global:' + str(tmp_file)], capture_output=True)
-            except subprocess.CalledProcessError as err:
-                print (f"ERROR: file tags not written {err}")
-            if result.returncode != 0:
-                print(result)
-            else:
-                print (f"File saved: {result.stdout}")
-            try:
-                reult =  subprocess.run(['mkvpropedit', '--gui-mode', str(mediafile.file), '--edit', 'info', '--set',
-                                     f"title={mediafile.metadata['tags']['title']}"], capture_output=True)
-            except subprocess.CalledProcessError as err:
-                print (f"ERROR: title not set. {err}")
-            if result.returncode != 0:
-                print (result)
-            else:
-                print (f"Title set: {result.stdout}")
-            mediafile.changes = False
-            os.remove(tmp_file)
+        self.queue_saves(self.selected_files())
+
+    def save_all_files(self):
+        self.queue_saves([mediafile for mediafile in self.model.mediafiles if mediafile.changes])
+
+    #
+    # Files are saved on the thread pool, at most self.save_jobs at a time so a big batch doesn't take over the pool
+    # (or the disk). Progress and failures are reported in the status bar as each file completes.
+    #
+    # What gets written is snapshotted here on the GUI thread, the file can be edited while it saves. A file that is
+    # already being saved is saved again once that finishes, so the later edits aren't lost.
+    #
+    def queue_saves(self, mediafiles):
+        for mediafile in mediafiles:
+            if mediafile in self.saving:
+                self.save_again.add(mediafile)
+                continue
+            if not mediafile.analyzed:
+                # Never read so never edited, there is nothing to write.
+                self.save_finished_closing(mediafile, True)
+                continue
+            self.saving.add(mediafile)
+            self.save_queue.append((mediafile, mediafile.save_snapshot()))
+            self.save_total += 1
+        self.start_saves()
+
+    def start_saves(self):
+        while self.save_queue and self.saves_running < self.save_jobs:
+            mediafile, snapshot = self.save_queue.popleft()
+            worker = Worker(self.write_file, mediafile, snapshot, progress_callback=None)
+            worker.signals.result.connect(self.save_complete)
+            worker.signals.error.connect(lambda error, mediafile=mediafile: self.save_error(mediafile, error))
+            worker.signals.finished.connect(self.save_finished)
+            self.saves_running += 1
+            self.threadpool.start(worker)
+
+    # Runs on the worker thread.
+    def write_file(self, mediafile, snapshot, progress_callback):
+        log.info(f"Save file {mediafile.file}")
+        return mediafile, snapshot, mediafile.save_tags(snapshot)
+
+    def save_complete(self, result):
+        mediafile, snapshot, saved = result
+        self.saving.discard(mediafile)
+        if saved:
+            # Edits made while it was saving are still unsaved.
+            if mediafile.matches_snapshot(snapshot):
+                mediafile.changes = False
+            self.model.file_changed(mediafile)
+        else:
+            self.save_failures.append(mediafile)
+        self.save_done += 1
+        self.save_progress()
+        self.save_finished_closing(mediafile, saved)
+
+    def save_error(self, mediafile, error):
+        exctype, value, trace = error
+        log.error(f"{mediafile.file} not saved: {value}")
+        self.saving.discard(mediafile)
+        self.save_failures.append(mediafile)
+        self.save_done += 1
+        self.save_progress()
+        self.save_finished_closing(mediafile, False)
+
+    #
+    # A file closed with "Save" stays in the list until it is saved, then it is closed. If the save fails it is left
+    # open (with its changes) and the user is told.
+    #
+    def save_finished_closing(self, mediafile, saved):
+        if mediafile in self.save_again:
+            self.save_again.discard(mediafile)
+            if saved and mediafile.changes:
+                self.queue_saves([mediafile])
+                return
+        if mediafile not in self.closing:
+            return
+        self.closing.discard(mediafile)
+        if not saved:
+            QMessageBox.critical(self, "Error", f"{os.path.basename(mediafile.file)} could not be saved, it has been "
+                                 "left open.", QMessageBox.Ok)
+            return
+        row = self.model.row_of(mediafile)
+        if row is not None:
+            if mediafile in self.selected_files():
+                self.clear_metadata_display()
+            self.model.remove_file(row)
+
+    def save_finished(self):
+        self.saves_running -= 1
+        self.start_saves()
+
+    def save_progress(self):
+        message = f"Saved {self.save_done - len(self.save_failures)} of {self.save_total} files"
+        if self.save_failures:
+            failed = ', '.join(os.path.basename(mediafile.file) for mediafile in self.save_failures)
+            message += f", {len(self.save_failures)} failed: {failed}"
+        self.statusbar.showMessage(message)
+        if self.save_done == self.save_total:
+            # Batch finished, start counting afresh next time.
+            self.save_done = self.save_total = 0
+            self.save_failures = []
+
     #
     # Close the currently selected file
     #
     def close_file(self):
-        indexes = self.media_file_view.selectedIndexes()
+        files = self.selected_files()
         self.media_file_view.clearSelection()
-        for index in indexes:
-            file  = self.model.mediafiles[index.row()]
+        for file in files:
             if file.changes:
                 button = QMessageBox.warning(self, "Unsaved Tags!", f"{os.path.basename(file.file)} has unsaved changes to the tags save them?", 
                                           QMessageBox.Discard | QMessageBox.Save, defaultButton=QMessageBox.Discard)
-                if button == QMessageBox.Discard:
-                    del self.model.mediafiles[index.row()]
-                else:
-                    self.save_file(file)
-                    del self.model.mediafiles[index.row()]
-            else:
-                del self.model.mediafiles[index.row()]
+                if button != QMessageBox.Discard:
+                    # Closed once the save succeeds.
+                    self.closing.add(file)
+                    self.queue_saves([file])
+                    continue
+            elif file in self.saving:
+                # Its last save hasn't finished, close it after that.
+                self.closing.add(file)
+                continue
+            # Rows move as files are removed, look each one up again.
+            self.model.remove_file(self.model.row_of(file))
             self.clear_metadata_display()
         # nothing selected.
 
-    def open_file(self, files, progress_callback):
+    #
+    # Runs on the worker thread, the files are loaded on a pool of self.load_jobs threads and handed back to the
+    # GUI thread as each one completes.
+    #
+    # Files are only listed here, parsing the name is all it takes. Their tags are read as the view shows them
+    # (analyze_visible_file) or by the background prefetch once the whole list is in.
+    def open_file(self, files, first, progress_callback):
         file_count = len(files)
-        print (f"Open {file_count} files")
-        count = 1
-        for file in files:
-            mediafile = MediaFile(file)
-            progress_callback.emit((mediafile, count))
-            count += 1
+        log.info(f"Open {file_count} files")
+        for position, file in enumerate(files):
+            try:
+                mediafile = MediaFile(file, lazy=True)
+            except Exception as Err:
+                log.error(f"Unable to load {file}: {Err}")
+                continue
+            progress_callback.emit((mediafile, position + 1, first + position))
         return
 
     def add_file(self, progress):
-        mediafile, count = progress
-        print (f"open file #{count}")
-        self.model.mediafiles.append(mediafile)
-        self.model.layoutChanged.emit()
+        mediafile, count, order = progress
+        log.debug(f"open file #{count}")
+        self.pending_files.append((mediafile, order))
+        if not self.pending_timer.isActive():
+            self.pending_timer.start()
+
+    def add_pending_files(self):
+        self.pending_timer.stop()
+        files, self.pending_files = self.pending_files, []
+        if files:
+            self.model.insert_files(files)
 
     def open_complete(self):
+        self.add_pending_files()
+        self.prefetch_tags()
         indexes = self.media_file_view.selectedIndexes()
         if indexes:
             # Something selected. leave it be.
             return
-        # Select the last file added.
-        file_count = self.model.rowCount(QModelIndex)
-        index = self.model.index(file_count - 1,0)
+        # Select the last file the view has.
+        file_count = self.proxy.rowCount(QModelIndex())
+        index = self.proxy.index(file_count - 1, 0)
         self.media_file_view.selectionModel().setCurrentIndex(index,QItemSelectionModel.SelectCurrent)
 
+    def analyze_visible_file(self, mediafile):
+        worker = Worker(self.analyze_worker, mediafile, progress_callback=None)
+        worker.signals.result.connect(self.model.file_changed)
+        self.analyze_pool.start(worker)
+
+    def analyze_worker(self, mediafile, progress_callback):
+        mediafile.ensure_analyzed()
+        return mediafile
+
+    # Read the tags of everything not read yet in the background, in list order, with fewer threads than the
+    # files the view asks for get.
+    def prefetch_tags(self):
+        files = [mediafile for mediafile in self.model.mediafiles if not mediafile.analyzed]
+        if not files:
+            return
+        worker = Worker(self.prefetch_worker, files, progress_callback=self.prefetch_progress)
+        worker.signals.progress.connect(self.prefetch_progress)
+        self.threadpool.start(worker)
+
+    def prefetch_worker(self, files, progress_callback):
+        for mediafile in analyze_media_files(files, max(1, self.load_jobs // 2)):
+            progress_callback.emit((mediafile,))
+
+    def prefetch_progress(self, progress):
+        mediafile, = progress
+        self.model.file_changed(mediafile)
+
+    #
+    # The view asks for more rows when it is scrolled to the bottom. Rows that arrive while it is already there
+    # would otherwise wait for the next scroll, so fetch them if the last row is on screen.
+    #
+    def fetch_visible_rows(self):
+        count = self.proxy.rowCount(QModelIndex())
+        if count == 0:
+            return
+        rect = self.media_file_view.visualRect(self.proxy.index(count - 1, 0))
+        if self.media_file_view.viewport().rect().intersects(rect):
+            self.model.fetchMore(QModelIndex())
+
+    #
+    # The view shows the model through self.proxy, these map between view indexes and files.
+    #
+    def file_at(self, index):
+        return self.model.mediafiles[self.proxy.mapToSource(index).row()]
+
+    def selected_files(self):
+        return [self.file_at(index) for index in self.media_file_view.selectedIndexes()]
+
+    def current_file(self):
+        files = self.selected_files()
+        return files[0] if files else None
+
+    # The view index of mediafile, invalid when the filter hides it.
+    def view_index(self, mediafile):
+        row = self.model.row_of(mediafile)
+        if row is None:
+            return QModelIndex()
+        self.model.fetch_to(row)
+        return self.proxy.mapFromSource(self.model.index(row, 0))
+
+    def filter_changed_only(self, enabled):
+        self.proxy.set_filter(self.proxy.show, self.proxy.season, enabled)
+
+    def filter_show(self):
+        file = self.current_file()
+        if file and file.metadata['tags'].get('show'):
+            self.proxy.set_filter(file.metadata['tags']['show'], None, self.proxy.changed_only)
+
+    def filter_season(self):
+        file = self.current_file()
+        if file and file.metadata['tags'].get('show'):
+            tags = file.metadata['tags']
+            self.proxy.set_filter(tags['show'], tags.get('season'), self.proxy.changed_only)
+
+    def clear_filter(self):
+        self.actionShowChangedOnly.setChecked(False)
+        self.proxy.set_filter()
+
     def open_files (self, files):
-        worker = Worker(self.open_file, files, progress_callback=self.add_file)
+        # Reserve a block of load order numbers so the list keeps the order the files were asked for.
+        first = self.load_sequence
+        self.load_sequence += len(files)
+        worker = Worker(self.open_file, files, first, progress_callback=self.add_file)
         worker.signals.finished.connect(self.open_complete)
         worker.signals.progress.connect(self.add_file)
         self.threadpool.start(worker)
@@ -973,16 +3380,634 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         files, _ = QFileDialog.getOpenFileNames(self, 'Open Media files', self.current_path, 'Media Files (*.mkv *.mka)')
         self.open_files(files)
 
+#
+# Headless batch mode, tagmkv.py batch [--auto-match] dir|file ...
+# Runs the same load -> lookup -> write pipeline as the UI without ever creating a QApplication, so it can run from
+# cron on a server with no display.
+#
+class BatchTagger():
+    media_extensions = ('.mkv', '.mka')
+
+    def __init__(self, auto_match=False, dry_run=False, force=False, jobs=None, threshold=AutoMatcher.threshold):
+        self.dry_run = dry_run
+        self.force = force
+        self.jobs = jobs
+        # Without auto matching only a lone search result is taken.
+        self.matcher = AutoMatcher(threshold if auto_match else None)
+        self.tagged = []
+        self.skipped = []
+        self.failed = []
+        self.review = []
+        # (mediafile, why) for the failures that may well go away by themselves: 'lookup' when TMDb couldn't be
+        # asked, 'season' when TMDb doesn't have the episode (yet). Watch mode tries these again later.
+        self.retry = []
+        # Files saved and the seconds spent saving them in the current tag_files
+        self.saves = 0
+        self.save_time = 0.0
+
+    @classmethod
+    def find_media_files(cls, paths):
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                for root, dirs, names in os.walk(path):
+                    dirs.sort()
+                    for name in sorted(names):
+                        if name.lower().endswith(cls.media_extensions):
+                            files.append(os.path.join(root, name))
+            else:
+                files.append(path)
+        return files
+
+    def tag_file(self, match):
+        mediafile = match.mediafile
+        tags = mediafile.metadata['tags']
+        term = tags['show'] if int(tags['media_type']) == 10 else tags['title']
+        if match.status == 'error':
+            self.failed.append((mediafile, f"lookup failed: {match.error}"))
+            self.retry.append((mediafile, 'lookup'))
+            return
+        if match.status == 'none':
+            self.skipped.append((mediafile, f"nothing found for '{term}'"))
+            return
+        if match.status == 'missing':
+            self.skipped.append((mediafile, f"not on TMDb: {match.error}"))
+            return
+        if match.status == 'ambiguous':
+            self.review.append(match)
+            self.skipped.append((mediafile, f"{len(match.candidates)} possible matches for '{term}', needs review"))
+            return
+        if not match.fill():
+            if mediafile.is_daily():
+                self.skipped.append((mediafile, f"no episode aired on {tags['air_date']}"))
+            else:
+                self.skipped.append((mediafile, f"no episode {tags['episode']} in season {tags['season']}"))
+            self.retry.append((mediafile, 'season'))
+            return
+        if self.dry_run:
+            print (f"Would tag {mediafile.file} as {tags['tmdb']} '{tags['title']}'")
+            self.tagged.append(mediafile)
+        elif self.save(mediafile):
+            mediafile.changes = False
+            self.tagged.append(mediafile)
+        else:
+            self.failed.append((mediafile, "tags not written"))
+
+    # The files that need a human to pick the match, with the candidates found for them.
+    def write_review(self, review_file):
+        review = []
+        for match in self.review:
+            candidates = []
+            for score, result in match.candidates:
+                candidates.append({'id': result['id'], 'score': round(score, 3),
+                                   'title': AutoMatcher.result_field(result, 'title') or
+                                            AutoMatcher.result_field(result, 'name'),
+                                   'date': AutoMatcher.result_field(result, 'release_date') or
+                                           AutoMatcher.result_field(result, 'first_air_date')})
+            review.append({'file': match.mediafile.file, 'candidates': candidates})
+        with open(review_file, 'w') as f:
+            json.dump(review, f, indent=2)
+
+    def save(self, mediafile):
+        started = time.monotonic()
+        saved = mediafile.save_tags()
+        self.saves += 1
+        self.save_time += time.monotonic() - started
+        return saved
+
+    def tag_files(self, files):
+        log.info(f"Tagging {len(files)} files")
+        lookups = []
+        started = time.monotonic()
+        loaded = 0
+        for position, mediafile in load_media_files(files, self.jobs):
+            loaded += 1
+            tags = mediafile.metadata['tags']
+            if 'tmdb_id' in tags and not self.force:
+                self.skipped.append((mediafile, f"already tagged ({tags['tmdb']})"))
+            else:
+                lookups.append(mediafile)
+        load_time = time.monotonic() - started
+        self.saves = 0
+        self.save_time = 0.0
+        for match in self.matcher.match_all(lookups):
+            self.tag_file(match)
+        # Files are loaded in parallel so that rate is over the wall clock time, saves happen one at a time.
+        if loaded and load_time:
+            metrics().set('files_per_second', loaded / load_time, stage='load')
+        if self.saves and self.save_time:
+            metrics().set('files_per_second', self.saves / self.save_time, stage='save')
+        log.info(f"Loaded {loaded} files in {load_time:.1f}s, saved {self.saves} in {self.save_time:.1f}s",
+                 extra=log_fields(loaded=loaded, load_seconds=load_time, saved=self.saves,
+                                  save_seconds=self.save_time))
+
+    def run(self, paths, review_file=None):
+        self.tag_files(self.find_media_files(paths))
+        return self.report(review_file)
+
+    def report(self, review_file=None):
+        for mediafile, reason in self.skipped:
+            print (f"Skipped {mediafile.file}: {reason}")
+        for mediafile, reason in self.failed:
+            print (f"FAILED {mediafile.file}: {reason}")
+        if review_file:
+            self.write_review(review_file)
+        print (f"{len(self.tagged)} tagged, {len(self.skipped)} skipped ({len(self.review)} to review), "
+               f"{len(self.failed)} failed")
+        return 1 if self.failed else 0
+
+    # Forget the results reported so far, the files waiting for review are kept.
+    def clear(self):
+        self.tagged = []
+        self.skipped = []
+        self.failed = []
+        self.retry = []
+
+#
+# Watch mode, tagmkv.py watch [--auto-match] dir ...
+# New .mkv/.mka files dropped into the watched directories are tagged as soon as they stop changing. What has been
+# seen is kept in a manifest in the user cache dir so a restart only looks at what changed while it wasn't running.
+#
+
+#
+# The manifest remembers every directory (with its mtime) and media file (size, mtime, state) under the watched
+# directories. A directory whose mtime hasn't moved has had nothing added or removed, so a rescan only lists the
+# directories that changed and only stats the files still pending. A file rewritten in place doesn't move its
+# directory's mtime: while running inotify reports the write. A start with --verify-on-start (scan(stat_files=True))
+# stats every known file to catch what changed meanwhile, otherwise such a rewrite isn't noticed.
+# File states:
+#   pending  seen but not processed yet, changed_at is when its size or mtime last moved
+#   retry  failed in a way that may pass (TMDb unreachable, the episode not listed yet), pending again at retry_at
+#   tagged, skipped, failed  the outcome of tagging it
+#   existing  was already there the first time the directory was scanned (with --skip-existing)
+#
+class WatchManifest():
+    schema_version = 2
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(user_cache_dir(), 'watch.sqlite')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version == 1:
+            # What was tagged is worth keeping, version 2 only adds the retries.
+            self.db.execute('ALTER TABLE files ADD COLUMN retry_at REAL')
+            self.db.execute('ALTER TABLE files ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+            self.db.execute(f"PRAGMA user_version = {self.schema_version}")
+        elif version != self.schema_version:
+            self.db.execute('DROP TABLE IF EXISTS dirs')
+            self.db.execute('DROP TABLE IF EXISTS files')
+            self.db.execute(f"PRAGMA user_version = {self.schema_version}")
+        self.db.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, size INTEGER, '
+                        'mtime INTEGER, changed_at REAL, state TEXT, retry_at REAL, '
+                        'attempts INTEGER NOT NULL DEFAULT 0)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_dir ON files (dir)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_state ON files (state)')
+        self.db.commit()
+
+    @staticmethod
+    def is_media_file(name):
+        return name.lower().endswith(BatchTagger.media_extensions)
+
+    def known(self, path):
+        return self.db.execute('SELECT 1 FROM dirs WHERE path = ?', (path,)).fetchone() is not None
+
+    def subdirs(self, path):
+        return [row[0] for row in self.db.execute('SELECT path FROM dirs WHERE parent = ?', (path,))]
+
+    #
+    # Walk root, listing only the directories that changed since the last scan. With stat_files the files known in
+    # the unchanged directories are checked too, for the ones rewritten in place. Returns the new files found.
+    #
+    def scan(self, root, stat_files=False):
+        found = 0
+        stack = [os.path.abspath(root)]
+        while stack:
+            path = stack.pop()
+            try:
+                st = os.stat(path)
+            except OSError:
+                self.forget_dir(path)
+                continue
+            row = self.db.execute('SELECT mtime FROM dirs WHERE path = ?', (path,)).fetchone()
+            if row and row[0] == st.st_mtime_ns:
+                if stat_files:
+                    for file_row in self.db.execute('SELECT path FROM files WHERE dir = ?', (path,)).fetchall():
+                        self.note(file_row[0])
+                stack.extend(self.subdirs(path))
+                continue
+            found += self.scan_dir(path, st.st_mtime_ns, stack)
+        self.db.commit()
+        return found
+
+    def scan_dir(self, path, mtime, stack):
+        known_files = {row[0] for row in self.db.execute('SELECT path FROM files WHERE dir = ?', (path,))}
+        known_dirs = set(self.subdirs(path))
+        files = set()
+        dirs = set()
+        found = 0
+        try:
+            entries = list(os.scandir(path))
+        except OSError as Err:
+            log.warning(f"Unable to scan {path}: {Err}")
+            return 0
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.add(entry.path)
+                elif entry.is_file() and self.is_media_file(entry.name):
+                    files.add(entry.path)
+                    if entry.path not in known_files:
+                        self.note(entry.path, entry.stat())
+                        found += 1
+            except OSError:
+                continue
+        for gone in known_files - files:
+            self.forget(gone)
+        for gone in known_dirs - dirs:
+            self.forget_dir(gone)
+        stack.extend(dirs)
+        self.db.execute('INSERT OR REPLACE INTO dirs (path, parent, mtime) VALUES (?, ?, ?)',
+                        (path, os.path.dirname(path), mtime))
+        return found
+
+    # A file was created or written to, it is pending again unless it is exactly as we last left it.
+    def note(self, path, st=None):
+        try:
+            st = st or os.stat(path)
+        except OSError:
+            self.forget(path)
+            return
+        row = self.db.execute('SELECT size, mtime FROM files WHERE path = ?', (path,)).fetchone()
+        if row and tuple(row) == (st.st_size, st.st_mtime_ns):
+            return
+        self.db.execute('INSERT OR REPLACE INTO files (path, dir, size, mtime, changed_at, state) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        (path, os.path.dirname(path), st.st_size, st.st_mtime_ns, time.time(), 'pending'))
+
+    # The file has gone, so has any reason to keep its tags.
+    def forget(self, path):
+        self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+        if MediaFile.use_tag_cache:
+            tag_cache().remove(path)
+
+    def forget_dir(self, path):
+        prefix = os.path.join(path, '')
+        self.db.execute('DELETE FROM files WHERE dir = ? OR substr(dir, 1, ?) = ?', (path, len(prefix), prefix))
+        self.db.execute('DELETE FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?', (path, len(prefix), prefix))
+
+    def pending(self):
+        return self.db.execute("SELECT COUNT(*) FROM files WHERE state = 'pending'").fetchone()[0]
+
+    # The pending files that haven't changed for settle seconds, so the rip (or copy) has finished. Files whose retry
+    # is due are pending again, they finished changing long ago.
+    def ready(self, settle):
+        ready = []
+        now = time.time()
+        self.db.execute("UPDATE files SET state = 'pending', changed_at = 0 WHERE state = 'retry' AND retry_at <= ?",
+                        (now,))
+        rows = self.db.execute("SELECT path, size, mtime, changed_at FROM files WHERE state = 'pending'").fetchall()
+        for path, size, mtime, changed_at in rows:
+            try:
+                st = os.stat(path)
+            except OSError:
+                self.forget(path)
+                continue
+            if (st.st_size, st.st_mtime_ns) != (size, mtime):
+                self.db.execute('UPDATE files SET size = ?, mtime = ?, changed_at = ? WHERE path = ?',
+                                (st.st_size, st.st_mtime_ns, now, path))
+            elif now - changed_at >= settle:
+                ready.append(path)
+        self.db.commit()
+        return ready
+
+    # Record the outcome for a file, with its size and mtime after we (maybe) wrote to it.
+    def mark(self, path, state):
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.forget(path)
+            return
+        self.db.execute('UPDATE files SET size = ?, mtime = ?, state = ?, retry_at = NULL, attempts = 0 '
+                        'WHERE path = ?', (st.st_size, st.st_mtime_ns, state, path))
+
+    #
+    # Try the file again in delay seconds, delay(attempts) is given the attempts made so far. After max_attempts the
+    # outcome (state) stands. Returns False when it does.
+    #
+    def retry(self, path, state, delay, max_attempts):
+        row = self.db.execute('SELECT attempts FROM files WHERE path = ?', (path,)).fetchone()
+        if row is None or row[0] + 1 >= max_attempts:
+            self.mark(path, state)
+            return False
+        self.db.execute("UPDATE files SET state = 'retry', retry_at = ?, attempts = attempts + 1 WHERE path = ?",
+                        (time.time() + delay(row[0]), path))
+        return True
+
+    def mark_pending(self, root, state):
+        prefix = os.path.join(root, '')
+        self.db.execute("UPDATE files SET state = ? WHERE state = 'pending' AND (dir = ? OR substr(dir, 1, ?) = ?)",
+                        (state, root, len(prefix), prefix))
+        self.db.commit()
+
+    def commit(self):
+        self.db.commit()
+
+#
+# Just enough inotify (through ctypes, Linux only) to hear about files being written and directories appearing.
+#
+class Inotify():
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    event_header = struct.Struct('iIII')
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.watches = {}
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        self.watches[wd] = path
+
+    # Watch path and every directory under it.
+    def add_tree(self, path):
+        self.add_watch(path)
+        for root, dirs, names in os.walk(path):
+            for name in dirs:
+                self.add_watch(os.path.join(root, name))
+
+    # [(path, mask)] for the events that arrive within timeout seconds, path is None when the queue overflowed.
+    def read(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset + self.event_header.size <= len(data):
+            wd, mask, cookie, length = self.event_header.unpack_from(data, offset)
+            offset += self.event_header.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((None, mask))
+            elif mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+            elif wd in self.watches:
+                directory = self.watches[wd]
+                events.append((os.path.join(directory, os.fsdecode(name)) if name else directory, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class FolderWatcher():
+    # Seconds a file has to stay the same size before it is tagged.
+    settle = 30
+    # Seconds between rescans when polling.
+    interval = 60
+    # Lookups that failed are tried again after retry_delay seconds, doubling each time up to retry_max_delay. An
+    # episode TMDb didn't list is tried again once the cached season has expired.
+    retry_delay = 300
+    retry_max_delay = 6 * 3600
+    season_retry_delay = next(ttl for name, pattern, ttl in TMDbCache.endpoints if name == 'season')
+    max_attempts = 10
+
+    def __init__(self, roots, tagger, manifest=None, settle=None, interval=None, use_inotify=True, review_file=None,
+                 metrics_file=None, verify_on_start=False):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.tagger = tagger
+        self.manifest = manifest or WatchManifest()
+        self.settle = self.settle if settle is None else settle
+        self.interval = interval or self.interval
+        self.use_inotify = use_inotify
+        self.review_file = review_file
+        # Rewritten after every batch tagged, for a textfile collector to pick up.
+        self.metrics_file = metrics_file
+        # Stat every known file on the first scan, a big library makes that slow so it is only done when asked.
+        self.verify_on_start = verify_on_start
+        self.inotify = None
+
+    def start_inotify(self):
+        try:
+            self.inotify = Inotify()
+            for root in self.roots:
+                self.inotify.add_tree(root)
+        except OSError as Err:
+            log.warning(f"inotify unavailable ({Err}), polling every {self.interval}s")
+            if self.inotify:
+                self.inotify.close()
+            self.inotify = None
+
+    def scan(self, skip_existing=False, stat_files=False):
+        for root in self.roots:
+            first = not self.manifest.known(root)
+            found = self.manifest.scan(root, stat_files)
+            if first and skip_existing:
+                self.manifest.mark_pending(root, 'existing')
+            elif found:
+                log.info(f"{found} new files under {root}")
+
+    def handle_events(self, events):
+        for path, mask in events:
+            if path is None:
+                # Missed events, fall back to a rescan.
+                self.scan()
+            elif mask & Inotify.IN_ISDIR:
+                if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    try:
+                        self.inotify.add_tree(path)
+                    except OSError as Err:
+                        log.warning(f"Unable to watch {path}: {Err}")
+                    self.manifest.scan(path)
+                elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                    self.manifest.forget_dir(path)
+            elif WatchManifest.is_media_file(path):
+                if mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                    self.manifest.forget(path)
+                else:
+                    self.manifest.note(path)
+        self.manifest.commit()
+
+    def tag_ready(self):
+        ready = self.manifest.ready(self.settle)
+        if not ready:
+            return
+        self.tagger.tag_files(ready)
+        states = dict.fromkeys(ready, 'failed')
+        states.update((mediafile.file, 'tagged') for mediafile in self.tagger.tagged)
+        states.update((mediafile.file, 'skipped') for mediafile, reason in self.tagger.skipped)
+        states.update((mediafile.file, 'failed') for mediafile, reason in self.tagger.failed)
+        retry = {mediafile.file: why for mediafile, why in self.tagger.retry}
+        for path, state in states.items():
+            if path not in retry:
+                self.manifest.mark(path, state)
+            elif self.manifest.retry(path, state, self.retry_after(retry[path]), self.max_attempts):
+                log.info(f"Will try {path} again", extra=log_fields(reason=retry[path]))
+        self.manifest.commit()
+        self.tagger.report(self.review_file)
+        self.tagger.clear()
+        if self.metrics_file:
+            metrics().export(self.metrics_file)
+
+    # The delay before the next attempt, given the attempts made so far.
+    def retry_after(self, why):
+        if why == 'season':
+            return lambda attempts: self.season_retry_delay
+        return lambda attempts: min(self.retry_max_delay, self.retry_delay * 2 ** attempts)
+
+    # With once set, stop when nothing is left pending instead of watching forever.
+    def run(self, once=False, skip_existing=False):
+        if self.use_inotify and not once:
+            # Before the scan, so nothing written during it is missed.
+            self.start_inotify()
+        # Anything could have been added while we weren't running.
+        self.scan(skip_existing, stat_files=self.verify_on_start)
+        try:
+            while True:
+                self.tag_ready()
+                pending = self.manifest.pending()
+                if once and not pending:
+                    return 0
+                timeout = self.settle if pending else self.interval
+                if self.inotify:
+                    self.handle_events(self.inotify.read(timeout))
+                else:
+                    time.sleep(timeout)
+                    self.scan()
+        except KeyboardInterrupt:
+            return 0
+        finally:
+            if self.inotify:
+                self.inotify.close()
+
+#
+# Options shared by the UI, batch and watch, and those batch and watch share for tagging without the UI. Used as
+# argparse parents so each is only defined once.
+#
+def common_options():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--log', type=log_level, dest='loglevel', default="INFO",
+                        help='log level: DEBUG, INFO, WARNING or ERROR')
+    parser.add_argument('--log-format', choices=('text', 'json'), dest='log_format', default='text',
+                        help='log lines as text or one JSON object per line')
+    parser.add_argument('--metrics', type=str, dest='metrics_file',
+                        help='write timings and counters to this file, JSON or the Prometheus text format (.prom)')
+    parser.add_argument('--no-tag-cache', action='store_false', dest='tag_cache',
+                        help="don't use the on disk tag cache")
+    parser.add_argument('--jobs', type=int, dest='jobs', default=default_load_jobs(),
+                        help='number of files to load in parallel')
+    parser.add_argument('--offline', action='store_true', dest='offline',
+                        help='only use cached TMDb responses, never go to the network')
+    return parser
+
+def tagging_options():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--auto-match', action='store_true', dest='auto_match',
+                        help='pick the best search result when it is a confident match')
+    parser.add_argument('--threshold', type=float, dest='threshold', default=AutoMatcher.threshold,
+                        help='score (0-1) a match needs to be accepted with --auto-match')
+    parser.add_argument('--review', type=str, dest='review_file',
+                        help='write the files that need a match picking by hand to this JSON file')
+    parser.add_argument('--dry-run', action='store_true', dest='dry_run', help="look the files up but don't write them")
+    return parser
+
+def run_batch(argv):
+    parser = argparse.ArgumentParser(prog=f"{os.path.basename(sys.argv[0])} batch",
+                                     description='Tag Media files without the UI.',
+                                     parents=[common_options(), tagging_options()])
+    parser.add_argument('--force', action='store_true', dest='force', help='look up files that are already tagged')
+    parser.add_argument('paths', nargs='+', help='files or directories to tag')
+    args = parser.parse_args(argv)
+    setup_logging(args.loglevel, args.log_format)
+    MediaFile.use_tag_cache = args.tag_cache
+    TMDbSession.offline = args.offline
+    tmdb = setup_tmdb()
+    if not tmdb.api_key:
+        log.error("Put your tmdb API key in the TMDB_API_KEY environment variable")
+        return 2
+    tagger = BatchTagger(auto_match=args.auto_match, dry_run=args.dry_run, force=args.force, jobs=max(1, args.jobs),
+                         threshold=args.threshold)
+    status = tagger.run(args.paths, args.review_file)
+    tmdb_cache().print_stats()
+    tmdb_session().print_stats()
+    if args.metrics_file:
+        metrics().export(args.metrics_file)
+    return status
+
+def run_watch(argv):
+    parser = argparse.ArgumentParser(prog=f"{os.path.basename(sys.argv[0])} watch",
+                                     description='Tag Media files as they appear in a directory.',
+                                     parents=[common_options(), tagging_options()])
+    parser.add_argument('--settle', type=float, dest='settle', default=FolderWatcher.settle,
+                        help='seconds a file has to stop changing before it is tagged')
+    parser.add_argument('--interval', type=float, dest='interval', default=FolderWatcher.interval,
+                        help='seconds between rescans when inotify is not available')
+    parser.add_argument('--poll', action='store_false', dest='inotify', help="rescan every --interval, don't use inotify")
+    parser.add_argument('--skip-existing', action='store_true', dest='skip_existing',
+                        help='the first time a directory is watched, leave the files already in it alone')
+    parser.add_argument('--once', action='store_true', dest='once',
+                        help='tag what is new since the last run and exit')
+    parser.add_argument('--verify-on-start', action='store_true', dest='verify_on_start',
+                        help='check every known file for changes made in place while not running')
+    parser.add_argument('dirs', nargs='+', help='directories to watch')
+    args = parser.parse_args(argv)
+    setup_logging(args.loglevel, args.log_format)
+    MediaFile.use_tag_cache = args.tag_cache
+    TMDbSession.offline = args.offline
+    tmdb = setup_tmdb()
+    if not tmdb.api_key:
+        log.error("Put your tmdb API key in the TMDB_API_KEY environment variable")
+        return 2
+    tagger = BatchTagger(auto_match=args.auto_match, dry_run=args.dry_run, jobs=max(1, args.jobs),
+                         threshold=args.threshold)
+    watcher = FolderWatcher(args.dirs, tagger, settle=args.settle, interval=args.interval, use_inotify=args.inotify,
+                            review_file=args.review_file, metrics_file=args.metrics_file,
+                            verify_on_start=args.verify_on_start)
+    status = watcher.run(once=args.once, skip_existing=args.skip_existing)
+    tmdb_cache().print_stats()
+    tmdb_session().print_stats()
+    return status
+
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Tag Media files with metadata from the Internet.')
-    parser.add_argument('--log', type=str, dest='loglevel', default="INFO")
+    if sys.argv[1:2] == ['batch']:
+        sys.exit(run_batch(sys.argv[2:]))
+    if sys.argv[1:2] == ['watch']:
+        sys.exit(run_watch(sys.argv[2:]))
+    parser = argparse.ArgumentParser(description='Tag Media files with metadata from the Internet.',
+                                     parents=[common_options()])
     parser.add_argument('files', nargs=argparse.REMAINDER)
     args = parser.parse_args()
+    setup_logging(args.loglevel, args.log_format)
+    MediaFile.use_tag_cache = args.tag_cache
+    TMDbSession.offline = args.offline
     app = QApplication(sys.argv)
-    win = MainWindow()
-    #win.setLogLevel(args.loglevel)
+    win = MainWindow(load_jobs=max(1, args.jobs))
     win.show()
     win.open_files(args.files)
 
-    sys.exit(app.exec())
+    status = app.exec()
+    if args.metrics_file:
+        metrics().export(args.metrics_file)
+    sys.exit(status)
 